@@ -0,0 +1,334 @@
+"""
+Synthetic-data benchmarks for each pipeline stage.
+
+Generates GSOD-shaped station files and an outcome parquet for every combination of
+years × stations × missing-data rate, then times and memory-profiles formatting,
+validation, filtering, model data building, training and prediction separately.
+Results are written as JSON so runs can be compared against a baseline.
+
+Usage:
+    PYTHONPATH=lambdas python benchmark.py --years 1 4 --stations 1 4 --missing-rates 0.05
+    PYTHONPATH=lambdas python benchmark.py --output results/benchmark.json --baseline old.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from model_data_builder import ModelDFBuilder
+from model_trainer import ModelTrainer
+from observation_filterer import ObservationFilterer
+from observation_formatter import ObservationFormatter
+from observation_validator import ObservationValidator
+
+BENCHMARK_START_DATE = "2010-01-01"
+
+# Per-column (mean, std, decimals, missing sentinel) of the generated measurements, roughly
+# matching a temperate GSOD station
+MEASUREMENT_PROFILES = {
+    'TEMP': (55.0, 12.0, 1, 9999.9),
+    'DEWP': (44.0, 9.0, 1, 9999.9),
+    'MAX': (65.0, 13.0, 1, 9999.9),
+    'MIN': (45.0, 10.0, 1, 9999.9),
+    'SLP': (1016.0, 7.0, 1, 9999.9),
+    'STP': (1010.0, 7.0, 1, 9999.9),
+    'WDSP': (6.0, 3.0, 1, 999.9),
+    'MXSPD': (12.0, 5.0, 1, 999.9),
+    'GUST': (22.0, 7.0, 1, 999.9),
+    'VISIB': (9.0, 2.0, 1, 999.9),
+    'SNDP': (0.5, 1.0, 1, 999.9),
+    'PRCP': (0.1, 0.2, 2, 99.99),
+}
+FRSHTT_FLAGS = ['000000', '010000', '100000', '110000', '010010', '001000']
+
+
+def generate_station_df(station_id: str, start_date: str, years: int, missing_rate: float,
+                        rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Generates one station's raw observations in the GSOD CSV layout.
+
+    Parameters:
+    - station_id: value of the STATION column.
+    - start_date: first observed date.
+    - years: number of years of daily observations.
+    - missing_rate: fraction of each measurement replaced by its GSOD missing sentinel.
+    - rng: random generator, so files are reproducible.
+    """
+    dates = pd.date_range(start=start_date, periods=365 * years, freq='D')
+    n = len(dates)
+    season = np.sin(2 * np.pi * (dates.dayofyear.to_numpy() - 110) / 365.25)
+
+    df = pd.DataFrame({
+        'STATION': station_id,
+        'NAME': f'SYNTHETIC STATION {station_id}, OR US',
+        'LATITUDE': round(rng.uniform(42, 46), 5),
+        'LONGITUDE': round(rng.uniform(-124, -117), 5),
+        'ELEVATION': round(rng.uniform(0, 1500), 1),
+        'DATE': dates.strftime('%Y-%m-%d'),
+    })
+    for col, (mean, std, decimals, sentinel) in MEASUREMENT_PROFILES.items():
+        values = mean + std * (0.6 * season + 0.4 * rng.standard_normal(n))
+        if col in ('WDSP', 'MXSPD', 'GUST', 'VISIB', 'SNDP', 'PRCP'):
+            values = np.abs(values)
+        values = values.round(decimals)
+        values[rng.random(n) < missing_rate] = sentinel
+        df[col] = values
+        df[f'{col}_ATTRIBUTES'] = 24
+    df['FRSHTT'] = rng.choice(FRSHTT_FLAGS, size=n)
+    df['FRSHTT_ATTRIBUTES'] = ''
+
+    return df
+
+
+def generate_outcome_df(start_date: str, years: int, rng: np.random.Generator,
+                        events_per_day: float = 2.0) -> pd.DataFrame:
+    """
+    Generates outcome events in the layout of data/synthetic_data.parquet: several
+    (date, outcome_of_int) rows per day, seasonal so features carry some signal.
+    """
+    dates = pd.date_range(start=start_date, periods=365 * years, freq='D')
+    counts = rng.poisson(events_per_day, size=len(dates))
+    event_dates = np.repeat(dates, counts)
+    season = np.sin(2 * np.pi * (event_dates.dayofyear.to_numpy() - 110) / 365.25)
+    outcome = np.abs(20000 * (1 + season) + 15000 * rng.standard_normal(len(event_dates)))
+
+    return pd.DataFrame({'date': event_dates.strftime('%Y-%m-%d'), 'outcome_of_int': outcome})
+
+
+def generate_dataset(directory: str, years: int, stations: int, missing_rate: float, seed: int = 0) -> dict:
+    """
+    Writes `stations` station CSVs and one outcome parquet to `directory`.
+
+    Returns:
+    - dict with the station file paths by station id and the outcome file path.
+    """
+    rng = np.random.default_rng(seed)
+    station_files = {}
+    for i in range(stations):
+        station_id = f'{99000000000 + i}'
+        path = os.path.join(directory, f'{station_id}.csv')
+        generate_station_df(station_id, BENCHMARK_START_DATE, years, missing_rate, rng).to_csv(path, index=False)
+        station_files[station_id] = path
+
+    outcome_file = os.path.join(directory, 'outcome.parquet')
+    generate_outcome_df(BENCHMARK_START_DATE, years, rng).to_parquet(outcome_file)
+
+    return {'station_files': station_files, 'outcome_file': outcome_file}
+
+
+def load_outcome_df(outcome_file: str) -> pd.DataFrame:
+    # Same daily aggregation as model_script.run_model_data_builder
+    outcome_df = pd.read_parquet(outcome_file)
+    outcome_df.date = pd.to_datetime(outcome_df.date)
+    outcome_df = outcome_df.groupby('date').outcome_of_int.sum().to_frame()
+    return outcome_df.reindex(
+        pd.date_range(start=outcome_df.index.min(), end=outcome_df.index.max(), freq='D'), fill_value=0
+    )
+
+
+def measure(func, setup, repeat: int = 3, memory: bool = True) -> tuple:
+    """
+    Times `func(*setup())` and reports the fastest of `repeat` runs. Inputs are rebuilt by
+    `setup` before every run (outside the timed region) since some stages modify them.
+    When `memory` is set, one extra run under tracemalloc reports the peak allocation.
+    """
+    timings = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - start)
+
+    measurement = {'seconds': min(timings), 'mean_seconds': sum(timings) / len(timings)}
+    if memory:
+        args = setup()
+        tracemalloc.start()
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        measurement['peak_memory_mb'] = peak / 2 ** 20
+
+    return measurement, result
+
+
+def benchmark_dataset(dataset: dict, test_split_date: str, model_params: dict, repeat: int = 3,
+                      memory: bool = True) -> list:
+    """
+    Benchmarks every pipeline stage on one generated dataset. Observation stages are timed
+    over all stations, the way the pipeline runs them.
+    """
+    raw_dfs = {s: pd.read_csv(path) for s, path in dataset['station_files'].items()}
+    results = []
+
+    def record(stage, measurement):
+        results.append({'stage': stage, **measurement})
+
+    measurement, formatted_dfs = measure(
+        lambda dfs: {s: ObservationFormatter(df).format() for s, df in dfs.items()},
+        lambda: (raw_dfs,), repeat, memory
+    )
+    record('format', measurement)
+
+    measurement, validity_dfs = measure(
+        lambda dfs: {s: ObservationValidator(df).validate() for s, df in dfs.items()},
+        lambda: (formatted_dfs,), repeat, memory
+    )
+    record('validate', measurement)
+
+    measurement, filtered_dfs = measure(
+        lambda dfs: {s: ObservationFilterer(df, validity_dfs[s]).filter() for s, df in dfs.items()},
+        lambda: ({s: df.copy() for s, df in formatted_dfs.items()},), repeat, memory
+    )
+    record('filter', measurement)
+
+    outcome_df = load_outcome_df(dataset['outcome_file'])
+    observation_dfs = {s: df[ModelDFBuilder.BASE_FEATURES] for s, df in filtered_dfs.items()}
+    measurement, model_df = measure(
+        lambda outcome, observations: ModelDFBuilder(outcome, observations).build_model_df(),
+        lambda: (outcome_df.copy(), {s: df.copy() for s, df in observation_dfs.items()}), repeat, memory
+    )
+    record('build_model_df', measurement)
+
+    target_col = outcome_df.columns[0]
+    measurement, (model, _, _) = measure(
+        lambda df: ModelTrainer(model_type='random_forest', model_params=model_params).train_and_evaluate(
+            df=df, target_col=target_col, test_split_date=test_split_date
+        ),
+        lambda: (model_df,), repeat, memory
+    )
+    record('train_and_evaluate', measurement)
+
+    input_df = model_df.drop(columns=[target_col])
+    measurement, _ = measure(model.predict, lambda: (input_df,), repeat, memory)
+    record('predict', measurement)
+
+    return results
+
+
+def run_benchmarks(years_list: list, stations_list: list, missing_rates: list, repeat: int = 3,
+                   memory: bool = True, model_params: dict = None, seed: int = 0) -> dict:
+    model_params = model_params or {}
+    results = []
+    for years in years_list:
+        # Hold out the last quarter of the generated period for evaluation
+        test_split_date = str((pd.Timestamp(BENCHMARK_START_DATE) + pd.Timedelta(days=int(365 * years * 0.75))).date())
+        for stations in stations_list:
+            for missing_rate in missing_rates:
+                with tempfile.TemporaryDirectory() as directory:
+                    dataset = generate_dataset(directory, years, stations, missing_rate, seed=seed)
+                    stage_results = benchmark_dataset(dataset, test_split_date, model_params, repeat, memory)
+
+                params = {
+                    'years': years,
+                    'stations': stations,
+                    'missing_rate': missing_rate,
+                    'observation_rows': 365 * years * stations,
+                }
+                for result in stage_results:
+                    results.append({**params, **result})
+                    print(
+                        f"years={years} stations={stations} missing={missing_rate:.2f} "
+                        f"{result['stage']:<20} {result['seconds']:.4f}s"
+                        + (f" peak {result['peak_memory_mb']:.1f} MB" if 'peak_memory_mb' in result else "")
+                    )
+
+    return {'metadata': get_run_metadata(repeat, model_params, seed), 'results': results}
+
+
+def get_run_metadata(repeat: int, model_params: dict, seed: int) -> dict:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'timestamp': pd.Timestamp.now(tz='UTC').isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'model_params': model_params,
+        'seed': seed,
+    }
+
+
+def compare_results(baseline: dict, current: dict, threshold: float = 1.2) -> list:
+    """
+    Matches stages by (years, stations, missing_rate, stage) and returns the current/baseline
+    time ratios, flagging any slower than `threshold`.
+    """
+    def key(result):
+        return result['years'], result['stations'], result['missing_rate'], result['stage']
+
+    baseline_by_key = {key(r): r for r in baseline['results']}
+    comparisons = []
+    for result in current['results']:
+        base = baseline_by_key.get(key(result))
+        if base is None:
+            continue
+        ratio = result['seconds'] / base['seconds'] if base['seconds'] else float('inf')
+        comparisons.append({
+            'years': result['years'],
+            'stations': result['stations'],
+            'missing_rate': result['missing_rate'],
+            'stage': result['stage'],
+            'baseline_seconds': base['seconds'],
+            'seconds': result['seconds'],
+            'ratio': ratio,
+            'regression': ratio > threshold,
+        })
+
+    return comparisons
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark each pipeline stage on synthetic station data.")
+    parser.add_argument("--years", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--stations", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--missing-rates", type=float, nargs="+", default=[0.05])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc peak-memory runs")
+    parser.add_argument("--n-estimators", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="results/benchmark.json")
+    parser.add_argument("--baseline", help="earlier benchmark output to compare against")
+    parser.add_argument("--regression-threshold", type=float, default=1.2)
+    args = parser.parse_args()
+
+    # Keep the per-run validation summaries out of the benchmark output
+    logging.getLogger('observation_validator').setLevel(logging.WARNING)
+
+    report = run_benchmarks(
+        args.years, args.stations, args.missing_rates,
+        repeat=args.repeat,
+        memory=not args.no_memory,
+        model_params={'n_estimators': args.n_estimators, 'random_state': args.seed},
+        seed=args.seed
+    )
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for c in compare_results(baseline, report, args.regression_threshold):
+            flag = "  REGRESSION" if c['regression'] else ""
+            print(
+                f"years={c['years']} stations={c['stations']} missing={c['missing_rate']:.2f} "
+                f"{c['stage']:<20} {c['baseline_seconds']:.4f}s -> {c['seconds']:.4f}s ({c['ratio']:.2f}x){flag}"
+            )
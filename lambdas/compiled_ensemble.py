@@ -0,0 +1,266 @@
+import json
+import os
+import uuid
+from typing import List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import fs as pa_fs
+
+from observation_store import resolve_filesystem
+
+
+NODE_COLUMNS = ['feature', 'threshold', 'children', 'value', 'missing_left', 'is_leaf']
+METADATA_KEY = b'compiled_ensemble'
+LOCAL_MODEL_DIR = '/tmp/compiled_models'
+PREDICT_BATCH_ROWS = 4096
+
+
+def is_compiled_ensemble(uri: str) -> bool:
+    return uri.endswith('.arrow')
+
+
+class CompiledEnsemble:
+    """
+    A tree ensemble flattened into contiguous node arrays, evaluated for a batch of rows at once.
+
+    Every tree's nodes are stored back to back; `roots` holds each tree's first node. Both
+    children of node i are at 2i (left) and 2i + 1 (right) of `children`, so a step is a single
+    lookup. A row goes left when its feature value is <= `threshold` (or, when the value is
+    missing, when `missing_left` is set) and right otherwise. Leaves point to themselves and
+    are flagged in `is_leaf`. The prediction is `base_score` plus `scale` times the sum of the
+    leaf values of all trees.
+
+    Inputs are compared as float32, like both sklearn and XGBoost do.
+    """
+    def __init__(self, feature, threshold, children, value, missing_left, is_leaf, roots, max_depth,
+                 feature_names: List[str], scale: float = 1.0, base_score: float = 0.0):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.value = value
+        self.missing_left = missing_left
+        # Stored as uint8; viewed as bool without copying
+        self.is_leaf = is_leaf.view(np.bool_)
+        self.roots = roots
+        self.max_depth = max_depth
+        self.feature_names_in_ = np.asarray(feature_names, dtype=object)
+        self.scale = scale
+        self.base_score = base_score
+
+    @classmethod
+    def from_random_forest(cls, model) -> 'CompiledEnsemble':
+        """
+        Compiles a fitted sklearn forest (or any ensemble of sklearn regression trees in
+        `estimators_`), whose prediction is the mean of its trees.
+        """
+        nodes = {column: [] for column in NODE_COLUMNS}
+        roots = []
+        max_depth = 0
+        offset = 0
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            node_ids = np.arange(tree.node_count, dtype=np.int32)
+            is_leaf = tree.children_left == -1
+
+            roots.append(offset)
+            nodes['feature'].append(np.where(is_leaf, 0, tree.feature).astype(np.int32))
+            nodes['threshold'].append(np.where(is_leaf, 0, tree.threshold))
+            nodes['children'].append(interleave_children(
+                np.where(is_leaf, node_ids, tree.children_left), np.where(is_leaf, node_ids, tree.children_right)
+            ) + offset)
+            nodes['value'].append(tree.value[:, 0, 0].astype(np.float64))
+            nodes['missing_left'].append(np.asarray(tree.missing_go_to_left, dtype=np.uint8))
+            nodes['is_leaf'].append(is_leaf.astype(np.uint8))
+            max_depth = max(max_depth, tree.max_depth)
+            offset += tree.node_count
+
+        return cls(
+            **{column: np.concatenate(arrays) for column, arrays in nodes.items()},
+            roots=np.asarray(roots, dtype=np.int32),
+            max_depth=max_depth,
+            feature_names=get_feature_names(model),
+            scale=1.0 / len(model.estimators_)
+        )
+
+    @classmethod
+    def from_xgboost(cls, booster, best_iteration: int = None) -> 'CompiledEnsemble':
+        """
+        Compiles an XGBoost regression booster (gbtree), using its trees up to `best_iteration`.
+
+        XGBoost goes left when a value is < its float32 split condition; that is the same as
+        <= the next float32 below it, which is what is stored as the threshold.
+        """
+        learner = json.loads(booster.save_raw('json'))['learner']
+        trees = learner['gradient_booster']['model']['trees']
+        if best_iteration is not None:
+            trees = trees[:best_iteration + 1]
+        base_score = float(learner['learner_model_param']['base_score'].strip('[]'))
+
+        nodes = {column: [] for column in NODE_COLUMNS}
+        roots = []
+        max_depth = 0
+        offset = 0
+        for tree in trees:
+            left_children = np.asarray(tree['left_children'], dtype=np.int32)
+            node_ids = np.arange(len(left_children), dtype=np.int32)
+            is_leaf = left_children == -1
+            split_conditions = np.asarray(tree['split_conditions'], dtype=np.float32)
+
+            roots.append(offset)
+            nodes['feature'].append(np.where(is_leaf, 0, tree['split_indices']).astype(np.int32))
+            nodes['threshold'].append(
+                np.where(is_leaf, 0, np.nextafter(split_conditions, np.float32(-np.inf))).astype(np.float64)
+            )
+            nodes['children'].append(interleave_children(
+                np.where(is_leaf, node_ids, left_children), np.where(is_leaf, node_ids, tree['right_children'])
+            ) + offset)
+            nodes['value'].append(np.where(is_leaf, split_conditions, 0).astype(np.float64))
+            nodes['missing_left'].append(np.asarray(tree['default_left'], dtype=np.uint8))
+            nodes['is_leaf'].append(is_leaf.astype(np.uint8))
+            max_depth = max(max_depth, get_tree_depth(left_children, np.asarray(tree['right_children'])))
+            offset += len(left_children)
+
+        return cls(
+            **{column: np.concatenate(arrays) for column, arrays in nodes.items()},
+            roots=np.asarray(roots, dtype=np.int32),
+            max_depth=max_depth,
+            feature_names=booster.feature_names or [f'f{i}' for i in range(booster.num_features())],
+            base_score=base_score
+        )
+
+    @classmethod
+    def from_model(cls, model) -> 'CompiledEnsemble':
+        # XGBoostModel (model_trainer) wraps a booster; anything else is taken as an sklearn forest
+        if hasattr(model, 'booster'):
+            return cls.from_xgboost(model.booster, model.best_iteration)
+        return cls.from_random_forest(model)
+
+    @property
+    def node_count(self) -> int:
+        return len(self.feature)
+
+    @property
+    def left(self) -> np.ndarray:
+        return self.children[0::2]
+
+    @property
+    def right(self) -> np.ndarray:
+        return self.children[1::2]
+
+    def predict(self, X) -> np.ndarray:
+        """
+        Predicts for a DataFrame (columns are taken in the order the model was fitted on) or a
+        2D array, in batches of PREDICT_BATCH_ROWS rows. Each step advances every (row, tree)
+        pair that hasn't reached a leaf yet by one level, so the work is the total path length
+        rather than rows x trees x max_depth.
+        """
+        if isinstance(X, pd.DataFrame):
+            X = X[list(self.feature_names_in_)]
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        feature_count = X.shape[1]
+        tree_count = len(self.roots)
+
+        predictions = np.empty(len(X), dtype=np.float64)
+        for start in range(0, len(X), PREDICT_BATCH_ROWS):
+            batch = X[start:start + PREDICT_BATCH_ROWS]
+            flat_batch = batch.reshape(-1)
+            # (row, tree) pairs, row by row
+            nodes = np.tile(self.roots, len(batch))
+            row_offsets = np.repeat(np.arange(len(batch), dtype=np.int64) * feature_count, tree_count)
+            active = np.flatnonzero(~self.is_leaf[nodes])
+            while active.size:
+                active_nodes = nodes[active]
+                values = flat_batch[row_offsets[active] + self.feature[active_nodes]]
+                # NaN compares false, so missing values go right unless their node sends them left
+                go_right = ~(values <= self.threshold[active_nodes])
+                missing = np.isnan(values)
+                if missing.any():
+                    go_right[missing] = self.missing_left[active_nodes[missing]] == 0
+                next_nodes = self.children[2 * active_nodes + go_right]
+                nodes[active] = next_nodes
+                active = active[~self.is_leaf[next_nodes]]
+
+            leaf_sums = self.value[nodes].reshape(len(batch), tree_count).sum(axis=1)
+            predictions[start:start + len(batch)] = leaf_sums * self.scale + self.base_score
+
+        return predictions
+
+    def write(self, uri: str) -> str:
+        """
+        Writes the node arrays as an uncompressed Arrow IPC file, which read() memory-maps.
+        """
+        arrays = {column: getattr(self, column) for column in NODE_COLUMNS}
+        # One (left, right) pair per node, so the column has as many rows as the others
+        arrays['children'] = pa.FixedSizeListArray.from_arrays(pa.array(self.children), 2)
+        arrays['is_leaf'] = self.is_leaf.view(np.uint8)
+        table = pa.table(arrays).replace_schema_metadata({
+            METADATA_KEY: json.dumps({
+                'roots': self.roots.tolist(),
+                'max_depth': int(self.max_depth),
+                'feature_names': [str(f) for f in self.feature_names_in_],
+                'scale': self.scale,
+                'base_score': self.base_score,
+            }).encode()
+        })
+
+        filesystem, path = resolve_filesystem(uri)
+        if isinstance(filesystem, pa_fs.LocalFileSystem):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with filesystem.open_output_stream(path) as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+        return uri
+
+    @classmethod
+    def read(cls, uri: str) -> 'CompiledEnsemble':
+        """
+        Memory-maps an ensemble written by write(); the node arrays are views of the mapped file.
+        S3 files are first copied to local disk, and the copy is unlinked once mapped.
+        """
+        filesystem, path = resolve_filesystem(uri)
+        local_path = path
+        if not isinstance(filesystem, pa_fs.LocalFileSystem):
+            os.makedirs(LOCAL_MODEL_DIR, exist_ok=True)
+            local_path = os.path.join(LOCAL_MODEL_DIR, f'{uuid.uuid4().hex}.arrow')
+            pa_fs.copy_files(path, local_path, source_filesystem=filesystem,
+                             destination_filesystem=pa_fs.LocalFileSystem())
+
+        try:
+            table = pa.ipc.open_file(pa.memory_map(local_path, 'r')).read_all()
+        finally:
+            if local_path != path:
+                os.remove(local_path)
+
+        metadata = json.loads(table.schema.metadata[METADATA_KEY])
+        arrays = {column: table.column(column).chunk(0) for column in NODE_COLUMNS}
+        arrays['children'] = arrays['children'].flatten()
+        return cls(
+            **{column: array.to_numpy(zero_copy_only=True) for column, array in arrays.items()},
+            roots=np.asarray(metadata['roots'], dtype=np.int32),
+            max_depth=metadata['max_depth'],
+            feature_names=metadata['feature_names'],
+            scale=metadata['scale'],
+            base_score=metadata['base_score']
+        )
+
+
+def interleave_children(left_children: np.ndarray, right_children: np.ndarray) -> np.ndarray:
+    return np.column_stack([left_children, right_children]).astype(np.int32).reshape(-1)
+
+
+def get_feature_names(model) -> List[str]:
+    if hasattr(model, 'feature_names_in_'):
+        return list(model.feature_names_in_)
+    return [f'x{i}' for i in range(model.n_features_in_)]
+
+
+def get_tree_depth(left_children: np.ndarray, right_children: np.ndarray) -> int:
+    depth = 0
+    level = [0]
+    while level:
+        level = [child for node in level for child in (left_children[node], right_children[node]) if child != -1]
+        depth += bool(level)
+    return depth
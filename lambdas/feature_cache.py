@@ -0,0 +1,115 @@
+import hashlib
+import json
+import logging
+import os
+import uuid
+from typing import Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import fs as pa_fs
+
+from observation_store import resolve_filesystem
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 512 << 20
+
+
+def hash_feature_source(obs_df: pd.DataFrame) -> str:
+    """
+    Content hash of the observations a station's features are computed from (values and
+    dates), so cached features are invalidated whenever the filtered observations change.
+    """
+    row_hashes = pd.util.hash_pandas_object(obs_df, index=True).to_numpy()
+    column_names = json.dumps([str(c) for c in obs_df.columns]).encode()
+    return hashlib.sha256(column_names + row_hashes.tobytes()).hexdigest()
+
+
+class FeatureCache:
+    """
+    Parquet cache of computed station features on local disk or under an S3 prefix.
+
+    Entries are keyed by station, source version, and feature spec. Once the cache grows past
+    `max_bytes`, the least recently used entries are evicted. On local disk a hit refreshes the
+    entry's modification time. S3 objects can't be touched without rewriting them, so there the
+    entries are evicted in write order (an S3 lifecycle rule on the prefix works as well).
+    """
+    def __init__(self, uri: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.uri = uri
+        self.max_bytes = max_bytes
+        self.filesystem, self.path = resolve_filesystem(uri.rstrip('/'))
+        self.is_local = isinstance(self.filesystem, pa_fs.LocalFileSystem)
+        self.filesystem.create_dir(self.path, recursive=True)
+
+    @staticmethod
+    def make_key(station: str, source_version: str, feature_spec: dict) -> str:
+        """
+        Parameters:
+        - station: station id.
+        - source_version: object version or content hash of the station's observations.
+        - feature_spec: everything else the features depend on (features, windows, dtype,
+          code version).
+        """
+        payload = json.dumps(
+            {'station': str(station), 'source_version': source_version, 'feature_spec': feature_spec},
+            sort_keys=True, default=str
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get_entry_path(self, key: str) -> str:
+        return f'{self.path}/{key}.parquet'
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        entry_path = self.get_entry_path(key)
+        try:
+            df = pq.read_table(entry_path, filesystem=self.filesystem).to_pandas()
+        except (FileNotFoundError, OSError):
+            return None
+
+        if self.is_local:
+            os.utime(entry_path)
+        return df
+
+    def put(self, key: str, df: pd.DataFrame):
+        entry_path = self.get_entry_path(key)
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        if self.is_local:
+            # Write then rename, so concurrent readers never see a partial entry
+            temp_path = f'{entry_path}.{uuid.uuid4().hex}.tmp'
+            pq.write_table(table, temp_path, filesystem=self.filesystem)
+            self.filesystem.move(temp_path, entry_path)
+        else:
+            pq.write_table(table, entry_path, filesystem=self.filesystem)
+
+        self.evict()
+
+    def evict(self) -> int:
+        """
+        Deletes the least recently used entries until the cache fits in max_bytes.
+
+        Returns:
+        - Number of entries deleted.
+        """
+        entries = [
+            info for info in self.filesystem.get_file_info(pa_fs.FileSelector(self.path, allow_not_found=True))
+            if info.type == pa_fs.FileType.File and info.path.endswith('.parquet')
+        ]
+        total_bytes = sum(info.size for info in entries)
+        evicted = 0
+        for info in sorted(entries, key=lambda info: info.mtime):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                self.filesystem.delete_file(info.path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= info.size
+            evicted += 1
+
+        if evicted:
+            logger.info(f"Evicted {evicted} feature cache entries from {self.uri}")
+        return evicted
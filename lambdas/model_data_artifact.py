@@ -0,0 +1,144 @@
+import json
+import os
+import uuid
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import fs as pa_fs
+
+from observation_store import resolve_filesystem
+
+
+TARGET_COLUMN = 'outcome_of_int'
+DATE_COLUMN = 'date'
+FEATURES_COLUMN = 'features'
+FEATURE_NAMES_METADATA_KEY = b'feature_names'
+LOCAL_ARTIFACT_DIR = '/tmp/model_data'
+
+
+def is_model_data_artifact(uri: str) -> bool:
+    return uri.endswith('.feather')
+
+
+class ModelData:
+    """
+    Model data read from an artifact: the feature matrix as a DataFrame over a memory-mapped
+    float array (no copy is made by the read or by taking `features.to_numpy()`), and the
+    target, when the artifact has one.
+    """
+    def __init__(self, features: pd.DataFrame, target: Optional[pd.Series] = None):
+        self.features = features
+        self.target = target
+
+    @property
+    def index(self) -> pd.DatetimeIndex:
+        return self.features.index
+
+    def split(self, split_date) -> Tuple['ModelData', 'ModelData']:
+        """
+        Splits into the rows before and from `split_date`. The index is sorted, so both parts
+        are slices (views) of the same arrays.
+        """
+        position = self.index.searchsorted(pd.Timestamp(split_date))
+        return self.slice(0, position), self.slice(position, len(self.index))
+
+    def slice(self, start: int, stop: int) -> 'ModelData':
+        target = None if self.target is None else self.target.iloc[start:stop]
+        return ModelData(self.features.iloc[start:stop], target)
+
+    def to_df(self, target_col: str = TARGET_COLUMN) -> pd.DataFrame:
+        """
+        The target and features as one DataFrame, laid out like the builder's model data (copied).
+        """
+        if self.target is None:
+            return self.features.copy()
+        return pd.concat([self.target.rename(target_col), self.features], axis=1)
+
+    def select_dates(self, start_date=None, end_date=None) -> 'ModelData':
+        start = 0 if start_date is None else self.index.searchsorted(pd.Timestamp(start_date))
+        stop = len(self.index) if end_date is None else self.index.searchsorted(pd.Timestamp(end_date), side='right')
+        return self.slice(start, stop)
+
+
+def write_model_data_artifact(model_df: pd.DataFrame, uri: str, target_col: str = TARGET_COLUMN) -> str:
+    """
+    Writes model data as an uncompressed Arrow IPC (Feather v2) file that can be memory-mapped.
+
+    The features are stored row-major as one fixed-size list column, so the whole matrix is a
+    single contiguous buffer in the file. Features are upcast to a common float dtype (float32
+    when every feature is float32). Missing values are stored as NaN rather than as nulls.
+
+    Parameters:
+    - model_df: model data with a datetime index, the target (optional), and feature columns.
+    - uri: local path or S3 URI of the artifact.
+    - target_col: name of the target column.
+    """
+    feature_names = [c for c in model_df.columns if c != target_col]
+    feature_dtype = np.result_type(np.float32, *(model_df[c].dtype for c in feature_names))
+    if feature_dtype not in (np.float32, np.float64):
+        feature_dtype = np.dtype(np.float64)
+
+    matrix = np.empty((len(model_df), len(feature_names)), dtype=feature_dtype)
+    for position, feature_name in enumerate(feature_names):
+        matrix[:, position] = model_df[feature_name].to_numpy(dtype=feature_dtype, na_value=np.nan)
+
+    arrays = {
+        DATE_COLUMN: pa.array(pd.DatetimeIndex(model_df.index).to_numpy(dtype='datetime64[ns]')),
+        FEATURES_COLUMN: pa.FixedSizeListArray.from_arrays(pa.array(matrix.reshape(-1)), len(feature_names)),
+    }
+    if target_col in model_df.columns:
+        arrays[target_col] = pa.array(model_df[target_col].to_numpy(dtype=np.float64, na_value=np.nan))
+
+    table = pa.table(arrays).replace_schema_metadata({
+        FEATURE_NAMES_METADATA_KEY: json.dumps(feature_names).encode()
+    })
+
+    filesystem, path = resolve_filesystem(uri)
+    if isinstance(filesystem, pa_fs.LocalFileSystem):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with filesystem.open_output_stream(path) as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    return uri
+
+
+def get_feature_names(schema: pa.Schema) -> List[str]:
+    return json.loads(schema.metadata[FEATURE_NAMES_METADATA_KEY])
+
+
+def read_model_data_artifact(uri: str, target_col: str = TARGET_COLUMN) -> ModelData:
+    """
+    Memory-maps a model data artifact written by write_model_data_artifact. S3 artifacts are
+    first copied to local disk; the copy is unlinked once mapped, so its space is freed when
+    the returned arrays are released.
+    """
+    filesystem, path = resolve_filesystem(uri)
+    local_path = path
+    if not isinstance(filesystem, pa_fs.LocalFileSystem):
+        os.makedirs(LOCAL_ARTIFACT_DIR, exist_ok=True)
+        # Unique per read, so concurrent reads in one process never share a file
+        local_path = os.path.join(LOCAL_ARTIFACT_DIR, f'{uuid.uuid4().hex}.feather')
+        pa_fs.copy_files(path, local_path, source_filesystem=filesystem,
+                         destination_filesystem=pa_fs.LocalFileSystem())
+
+    try:
+        table = pa.ipc.open_file(pa.memory_map(local_path, 'r')).read_all()
+    finally:
+        if local_path != path:
+            os.remove(local_path)
+
+    feature_names = get_feature_names(table.schema)
+    features_column = table.column(FEATURES_COLUMN)
+    features_array = features_column.chunk(0) if features_column.num_chunks == 1 else features_column.combine_chunks()
+    matrix = features_array.flatten().to_numpy(zero_copy_only=True).reshape(-1, len(feature_names))
+
+    index = pd.DatetimeIndex(table.column(DATE_COLUMN).to_numpy())
+    features = pd.DataFrame(matrix, index=index, columns=feature_names, copy=False)
+    target = None
+    if target_col in table.column_names:
+        target = pd.Series(table.column(target_col).to_numpy(), index=index, name=target_col, copy=False)
+
+    return ModelData(features, target)
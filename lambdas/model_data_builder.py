@@ -1,7 +1,12 @@
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, List, Union
 
+import numpy as np
 import pandas as pd
 
+from feature_cache import FeatureCache, hash_feature_source
+
 
 class ModelDFBuilder:
     BASE_FEATURES = [
@@ -25,12 +30,54 @@ class ModelDFBuilder:
         30
     ]
     ROLLING_MEAN_SUFFIX = 'd_mean'
+    # Base features summed when lowering the resolution (like the outcome); every other column is averaged
+    SUM_FEATURES = [
+        'PRCP'
+    ]
+    # Bump whenever feature computation changes, so cached features are recomputed
+    FEATURE_VERSION = 1
 
-    def __init__(self, outcome_df: pd.DataFrame, observation_dfs_by_station_id: Dict[str, pd.DataFrame]):
+    def __init__(self, outcome_df: pd.DataFrame,
+                 observation_dfs_by_station_id: Dict[str, Union[pd.DataFrame, Callable[..., pd.DataFrame]]],
+                 feature_dtype: str = 'float64', workers: int = None, feature_cache: FeatureCache = None,
+                 source_versions_by_station_id: Dict[str, str] = None):
+        """
+        Parameters:
+        - outcome_df: outcome series indexed by date.
+        - observation_dfs_by_station_id: filtered observations indexed by date, by station id.
+          Each may also be a function that loads them, called with the `start_date` and
+          `end_date` of the observations the outcome dates need (see
+          get_observation_date_range), and only if the station's features are not cached.
+          Frames are trimmed to that range too, so features only cover the rows they need.
+        - feature_dtype: dtype of the rolling mean features; 'float32' halves their memory.
+          Means are always accumulated in float64.
+        - workers: threads used to build station feature blocks concurrently (defaults to
+          ThreadPoolExecutor's choice; 1 builds them serially). Inputs are never modified, so
+          the same frames can be shared by several builders.
+        - feature_cache: cache of computed station features, keyed by the station's source
+          version and the feature spec (None always computes them).
+        - source_versions_by_station_id: versions of the stores each station is loaded from
+          (e.g. from observation_store.get_station_observations_version). Stations without one
+          are versioned by a content hash of their observations.
+        """
         self.outcome_df = outcome_df
         self.observation_dfs_by_station = observation_dfs_by_station_id
+        self.feature_dtype = np.dtype(feature_dtype)
+        self.workers = workers
+        self.feature_cache = feature_cache
+        self.source_versions_by_station = source_versions_by_station_id or {}
 
         self.outcome_column_name = outcome_df.columns[0]
+        self.daily_model_df = None
+
+    @classmethod
+    def get_observation_date_range(cls, start_date, end_date):
+        """
+        Date range of observations needed to build features for [start_date, end_date]:
+        the rolling windows reach back max(WINDOW_DAYS) - 1 days before start_date.
+        """
+        warm_up = pd.Timedelta(days=max(cls.WINDOW_DAYS) - 1)
+        return pd.Timestamp(start_date) - warm_up, pd.Timestamp(end_date)
 
     def build_model_df(self, resolution_days: int = 1) -> pd.DataFrame:
         """
@@ -38,37 +85,250 @@ class ModelDFBuilder:
         Computes additional features based on the base features and specified window days.
         Resamples the data to the specified resolution in days.
         """
-        model_df = self.combine_obs_with_outcome()
-        model_df = self.change_model_data_resolution(model_df, resolution_days)
+        return self.build_model_dfs([resolution_days])[resolution_days]
+
+    def build_model_dfs(self, resolutions: List[int]) -> Dict[int, pd.DataFrame]:
+        """
+        Builds the model data at several resolutions (in days) from a single daily build, which
+        is kept on the builder for later calls.
+        """
+        if self.daily_model_df is None:
+            self.daily_model_df = self.combine_obs_with_outcome()
+
+        return self.change_model_data_resolutions(self.daily_model_df, resolutions)
 
-        return model_df
+    @staticmethod
+    def get_append_start_date(base_model_df: pd.DataFrame) -> pd.Timestamp:
+        """
+        First date to build when extending model data built earlier: the start of its last
+        period, which is rebuilt since its outcome dates may not have been complete. Building
+        from there keeps the appended periods aligned with the earlier ones.
+        """
+        if not isinstance(base_model_df.index, pd.DatetimeIndex) or base_model_df.empty:
+            raise ValueError("Model data to extend must be non-empty with a datetime index.")
+
+        return base_model_df.index.max()
+
+    @staticmethod
+    def append_model_df(base_model_df: pd.DataFrame, appended_model_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Extends model data built earlier with model data built (by the same stations and
+        resolution) from its get_append_start_date. Features don't depend on the date range
+        they are built over, so the result matches a build over the whole range.
+        """
+        missing_columns = set(base_model_df.columns) ^ set(appended_model_df.columns)
+        if missing_columns:
+            raise ValueError(f"Appended model data has different columns: {sorted(missing_columns)}")
+
+        append_start_date = ModelDFBuilder.get_append_start_date(base_model_df)
+        return pd.concat([
+            base_model_df[base_model_df.index < append_start_date],
+            appended_model_df.loc[appended_model_df.index >= append_start_date, base_model_df.columns]
+        ])
 
     def combine_obs_with_outcome(self):
-        self.outcome_df.sort_index(ascending=True, inplace=True)
-        start_date, end_date = self.outcome_df.index[0], self.outcome_df.index[-1]
-        dfs = [self.outcome_df]
-        for station, obs_df in self.observation_dfs_by_station.items():
-            obs_df = self.compute_additional_features(obs_df)
-
-            feature_columns = [
-                c for c in obs_df.columns if c in self.BASE_FEATURES or self.ROLLING_MEAN_SUFFIX in c
-            ]
-            feature_df = obs_df.loc[start_date:end_date, feature_columns]
-            feature_df.columns = [f'{c}_{station}' for c in feature_df.columns]
-            dfs.append(feature_df)
-
-        model_data_df = pd.concat(dfs, axis=1)
+        outcome_df = self.outcome_df.sort_index(ascending=True)
+        start_date, end_date = outcome_df.index[0], outcome_df.index[-1]
+
+        stations = list(self.observation_dfs_by_station)
+        observations = list(self.observation_dfs_by_station.values())
+        build = partial(self.build_station_feature_df, start_date=start_date, end_date=end_date)
+        if self.workers == 1 or len(stations) <= 1:
+            feature_dfs = list(map(build, stations, observations))
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                feature_dfs = list(executor.map(build, stations, observations))
+
+        model_data_df = pd.concat([outcome_df] + feature_dfs, axis=1)
         model_data_df.loc[:, self.outcome_column_name] = model_data_df.loc[:, self.outcome_column_name].fillna(0)
 
         return model_data_df
 
+    def build_station_feature_df(self, station: str, observations, start_date, end_date) -> pd.DataFrame:
+        """
+        Base and rolling mean features of one station between start_date and end_date, with
+        columns suffixed by the station id. Rolling means use the observations before
+        start_date as warm-up.
+        """
+        obs_df = self.get_station_features(station, observations, start_date, end_date)
+
+        feature_columns = [
+            c for c in obs_df.columns if c in self.BASE_FEATURES or self.ROLLING_MEAN_SUFFIX in c
+        ]
+        feature_df = obs_df.loc[start_date:end_date, feature_columns]
+        feature_df.columns = [f'{c}_{station}' for c in feature_df.columns]
+
+        return feature_df
+
+    def get_feature_spec(self) -> dict:
+        return {
+            'base_features': self.BASE_FEATURES,
+            'window_days': self.WINDOW_DAYS,
+            'feature_dtype': self.feature_dtype.name,
+            'feature_version': self.FEATURE_VERSION,
+        }
+
+    def load_observations(self, observations, start_date, end_date) -> pd.DataFrame:
+        """
+        Loads (or trims) a station's observations to those the features for
+        [start_date, end_date] depend on.
+        """
+        if callable(observations):
+            observation_start_date, observation_end_date = self.get_observation_date_range(start_date, end_date)
+            observations = observations(start_date=observation_start_date, end_date=observation_end_date)
+
+        return self.trim_to_feature_range(observations, start_date, end_date)
+
+    @staticmethod
+    def load_observation_history(observations) -> pd.DataFrame:
+        """
+        Loads all of a station's observations.
+        """
+        return observations() if callable(observations) else observations
+
+    def trim_to_feature_range(self, obs_df: pd.DataFrame, start_date, end_date) -> pd.DataFrame:
+        """
+        Keeps the rows between start_date and end_date plus the max(WINDOW_DAYS) - 1 rows before
+        them that the rolling windows reach back to, so the features in the range are identical
+        to those computed over the full history.
+        """
+        if not obs_df.index.is_monotonic_increasing:
+            return obs_df
+
+        first = obs_df.index.searchsorted(pd.Timestamp(start_date), side='left')
+        last = obs_df.index.searchsorted(pd.Timestamp(end_date), side='right')
+        return obs_df.iloc[max(first - (max(self.WINDOW_DAYS) - 1), 0):last]
+
+    def get_station_features(self, station: str, observations, start_date, end_date) -> pd.DataFrame:
+        """
+        Base and rolling mean features of a station for [start_date, end_date] and their
+        warm-up, read from the feature cache when the same observations were featurized before.
+        With a known source version, a cache hit skips loading the observations as well.
+
+        Cache entries cover the station's full history and are trimmed to the dates needed, so
+        builds over different date ranges (e.g. training and prediction) share them. The
+        features of a date don't depend on the range they were computed over (see
+        compute_rolling_means), so trimmed entries match features computed over the range.
+        """
+        if self.feature_cache is None:
+            return self.compute_additional_features(self.load_observations(observations, start_date, end_date))
+
+        obs_df = None
+        source_version = self.source_versions_by_station.get(station)
+        if source_version is None:
+            obs_df = self.load_observation_history(observations)
+            source_version = hash_feature_source(obs_df[self.BASE_FEATURES])
+
+        key = self.feature_cache.make_key(station, source_version, self.get_feature_spec())
+        features_df = self.feature_cache.get(key)
+        if features_df is None:
+            obs_df = self.load_observation_history(observations) if obs_df is None else obs_df
+            features_df = self.compute_additional_features(obs_df[self.BASE_FEATURES])
+            self.feature_cache.put(key, features_df)
+
+        return self.trim_to_feature_range(features_df, start_date, end_date)
+
     def compute_additional_features(self, obs_df: pd.DataFrame) -> pd.DataFrame:
-        for f in self.BASE_FEATURES:
-            for d in self.WINDOW_DAYS:
-                new_feature = f'{f}_{d}{self.ROLLING_MEAN_SUFFIX}'
-                obs_df[new_feature] = obs_df[f].rolling(window=d, min_periods=1).mean()
-        return obs_df
+        """
+        Adds the rolling mean of every base feature over every window, computed in a single
+        pass and appended as one block rather than column by column.
+        """
+        feature_names = [f'{f}_{d}{self.ROLLING_MEAN_SUFFIX}' for f in self.BASE_FEATURES for d in self.WINDOW_DAYS]
+        values = obs_df[self.BASE_FEATURES].to_numpy(dtype=np.float64, na_value=np.nan)
+        rolling_means = self.compute_rolling_means(values, self.WINDOW_DAYS, dtype=self.feature_dtype)
+
+        feature_df = pd.DataFrame(rolling_means, index=obs_df.index, columns=feature_names)
+        obs_df = obs_df.drop(columns=feature_names, errors='ignore')
+
+        # Pyarrow-backed observations (see observation_store.read_observations) become NumPy
+        # features with NaN for missing values, since that is what the models take
+        arrow_columns = [c for c in self.BASE_FEATURES if isinstance(obs_df[c].dtype, pd.ArrowDtype)]
+        if arrow_columns:
+            obs_df = obs_df.assign(**{
+                c: obs_df[c].to_numpy(dtype=obs_df[c].dtype.numpy_dtype, na_value=np.nan) for c in arrow_columns
+            })
+
+        return pd.concat([obs_df, feature_df], axis=1)
 
     @staticmethod
-    def change_model_data_resolution(df: pd.DataFrame, resolution_days: int) -> pd.DataFrame:
-        return df.resample(f'{resolution_days}D').sum()
+    def compute_rolling_means(values: np.ndarray, window_days: List[int], dtype=np.float64) -> np.ndarray:
+        """
+        Trailing means of each column of `values` over each window, skipping NaNs, with the
+        semantics of `rolling(window=d, min_periods=1).mean()`: a window with no observed
+        values is NaN.
+
+        Window sums are accumulated row by row over each window, newest first, so every mean
+        depends only on the values in its window and not on where the loaded range starts (as
+        it would with differences of cumulative sums). Features built over different date
+        ranges are therefore identical. Windows are accumulated in increasing length, each
+        continuing the previous one's sums.
+
+        Args:
+            values: (rows, features) array.
+            window_days: window lengths in rows.
+            dtype: dtype of the result.
+
+        Returns:
+            (rows, features * windows) array, ordered feature by feature with each feature's
+            windows in the order given.
+        """
+        n, feature_count = values.shape
+        observed = ~np.isnan(values)
+        # Pad the front so every window reaches back the same number of rows
+        padding = max(window_days) - 1
+        padded_values = np.zeros((padding + n, feature_count))
+        padded_values[padding:] = np.where(observed, values, 0)
+        padded_observed = np.zeros((padding + n, feature_count), dtype=np.int64)
+        padded_observed[padding:] = observed
+
+        result = np.empty((n, feature_count, len(window_days)), dtype=dtype)
+        window_sums = np.zeros((n, feature_count))
+        window_counts = np.zeros((n, feature_count), dtype=np.int64)
+        rows_summed = 0
+        for w in sorted(range(len(window_days)), key=lambda w: window_days[w]):
+            for offset in range(rows_summed, window_days[w]):
+                window_sums += padded_values[padding - offset:padding - offset + n]
+                window_counts += padded_observed[padding - offset:padding - offset + n]
+            rows_summed = window_days[w]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result[:, :, w] = np.where(window_counts > 0, window_sums / window_counts, np.nan)
+
+        return result.reshape(n, feature_count * len(window_days))
+
+    def get_sum_columns(self) -> List[str]:
+        return [self.outcome_column_name] + [
+            f'{f}_{station}' for f in self.SUM_FEATURES for station in self.observation_dfs_by_station
+        ]
+
+    def change_model_data_resolution(self, df: pd.DataFrame, resolution_days: int) -> pd.DataFrame:
+        return self.change_model_data_resolutions(df, [resolution_days])[resolution_days]
+
+    def change_model_data_resolutions(self, df: pd.DataFrame, resolutions: List[int]) -> Dict[int, pd.DataFrame]:
+        """
+        Aggregates daily model data to each resolution: the outcome and SUM_FEATURES are summed,
+        all other columns averaged over their observed days. Empty periods are 0.
+
+        Aggregation is hierarchical: each resolution is built from the per-period sums and
+        observed-day counts of the coarsest finer resolution that divides it (e.g. 28 days from
+        7 days), since all periods are anchored on the first day.
+        """
+        sum_columns = [c for c in self.get_sum_columns() if c in df.columns]
+        mean_columns = [c for c in df.columns if c not in sum_columns]
+
+        sums_and_counts = {}
+        model_dfs = {}
+        for resolution_days in sorted(set(resolutions)):
+            divisors = [r for r in sums_and_counts if resolution_days % r == 0]
+            base_sums, base_counts = sums_and_counts[max(divisors)] if divisors else (df, df.notna())
+
+            sums = base_sums.resample(f'{resolution_days}D').sum()
+            counts = base_counts.resample(f'{resolution_days}D').sum()
+            sums_and_counts[resolution_days] = (sums, counts)
+
+            model_df = sums.copy()
+            if mean_columns:
+                means = sums[mean_columns] / counts[mean_columns].where(counts[mean_columns] > 0)
+                model_df[mean_columns] = means.fillna(0).astype(df.dtypes[mean_columns].to_dict())
+            model_dfs[resolution_days] = model_df
+
+        return model_dfs
@@ -1,16 +1,74 @@
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import awswrangler as wr
 import pandas as pd
 
 from observation_handlers import log_invocation_details, logger
+from observation_store import get_station_observations_version, read_station_observations
+from feature_cache import FeatureCache
 from model_data_builder import ModelDFBuilder
+from compiled_ensemble import CompiledEnsemble, is_compiled_ensemble
+from model_data_artifact import is_model_data_artifact, read_model_data_artifact, write_model_data_artifact
 import model_s3_interface
 from model_trainer import ModelTrainer
 from utilities import get_bucket_and_key_from_s3_uri
 
 
+def load_model(model_s3_uri):
+    """
+    Loads a model by URI: a compiled ensemble (.arrow) is memory-mapped, anything else is
+    loaded as a pickled model through the model cache.
+    """
+    if is_compiled_ensemble(model_s3_uri):
+        return CompiledEnsemble.read(model_s3_uri)
+    model_bucket, model_key = get_bucket_and_key_from_s3_uri(model_s3_uri)
+    return model_s3_interface.load_model_from_s3(bucket_name=model_bucket, s3_key=model_key)
+
+
+def read_model_df(model_data_s3_uri):
+    if is_model_data_artifact(model_data_s3_uri):
+        return read_model_data_artifact(model_data_s3_uri).to_df()
+    return wr.s3.read_parquet(model_data_s3_uri)
+
+
+def write_model_df(model_df, model_data_s3_uri_stem, feather=False):
+    if feather:
+        return write_model_data_artifact(model_df, f'{model_data_s3_uri_stem}.feather')
+    # The date index is kept, so the model data can be split by date and extended later
+    model_data_s3_uri = f'{model_data_s3_uri_stem}.parquet'
+    wr.s3.to_parquet(model_df, path=model_data_s3_uri, index=True)
+    return model_data_s3_uri
+
+
+def get_model_df_builder(outcome_df, observation_s3_uris_by_station_id, feature_dtype='float64', arrow=False):
+    # Observations are loaded by the builder, only for the dates (and columns) the features for the
+    # outcome dates depend on, and only for stations whose features aren't cached
+    observation_loaders_by_station_id = {
+        station_id: partial(read_station_observations, s3_uri, columns=ModelDFBuilder.BASE_FEATURES, arrow=arrow)
+        for station_id, s3_uri in observation_s3_uris_by_station_id.items()
+    }
+
+    feature_cache = None
+    source_versions_by_station_id = None
+    if os.environ.get('FEATURE_CACHE_URI'):
+        feature_cache = FeatureCache(os.environ['FEATURE_CACHE_URI'])
+        source_versions_by_station_id = {
+            station_id: get_station_observations_version(s3_uri)
+            for station_id, s3_uri in observation_s3_uris_by_station_id.items()
+        }
+
+    return ModelDFBuilder(
+        outcome_df=outcome_df,
+        observation_dfs_by_station_id=observation_loaders_by_station_id,
+        feature_dtype=feature_dtype,
+        feature_cache=feature_cache,
+        source_versions_by_station_id=source_versions_by_station_id
+    )
+
+
 @log_invocation_details
 def model_data_builder(event, context):
     outcome_s3_uri = event.get('outcome_s3_uri', None)
@@ -24,6 +82,18 @@ def model_data_builder(event, context):
     else:
         outcome_df = wr.s3.read_parquet(outcome_s3_uri)
 
+    # Extending earlier model data: features are only built for the periods after it
+    base_model_df = None
+    if event.get('base_model_data_s3_uri'):
+        if event.get('resolutions'):
+            raise ValueError("base_model_data_s3_uri extends one resolution's model data; it can't be used with resolutions.")
+        base_model_df = read_model_df(event['base_model_data_s3_uri'])
+        append_start_date = ModelDFBuilder.get_append_start_date(base_model_df)
+        outcome_df = outcome_df[outcome_df.index >= append_start_date]
+        # Starting on the rebuilt period keeps the appended periods aligned with the earlier ones
+        outcome_df = outcome_df.reindex(outcome_df.index.union([append_start_date]))
+        logger.info(f"Building model data from {append_start_date} to extend {event['base_model_data_s3_uri']}")
+
     observation_s3_uris_by_station_id = event['observation_s3_uris_by_station_id']
     resolution_days = event.get('resolution_days', 1)
     run_timestamp = event['run_timestamp']
@@ -32,27 +102,74 @@ def model_data_builder(event, context):
     if not observation_s3_uris_by_station_id:
         raise ValueError("No observation S3 URIs provided.")
 
-    observation_dfs_by_station_id = {
-        station_id: wr.s3.read_parquet(s3_uri)
-        for station_id, s3_uri in observation_s3_uris_by_station_id.items()
-    }
-
-    model_df_builder = ModelDFBuilder(
-        outcome_df=outcome_df,
-        observation_dfs_by_station_id=observation_dfs_by_station_id
+    model_df_builder = get_model_df_builder(
+        outcome_df,
+        observation_s3_uris_by_station_id,
+        feature_dtype=event.get('feature_dtype', 'float64'),
+        arrow=event.get('arrow', False)
     )
+    model_data_s3_prefix = f's3://{os.environ["OUTPUT_BUCKET"]}/model_data/location={location_name}/run_timestamp={run_timestamp}'
+    # Feather artifacts are memory-mapped by the trainer and runner instead of decoded
+    feather = event.get('model_data_format', 'parquet') == 'feather'
+
+    # Model data is written as a dataset partitioned by resolution, whether one or several are built.
+    # Several resolutions are derived from one daily build.
+    resolutions = event.get('resolutions')
+    if resolutions:
+        model_dfs = model_df_builder.build_model_dfs(resolutions=[int(r) for r in resolutions])
+        return {
+            str(resolution): write_model_df(model_df, f'{model_data_s3_prefix}/resolution={resolution}/data', feather)
+            for resolution, model_df in model_dfs.items()
+        }
+
     model_df = model_df_builder.build_model_df(resolution_days=resolution_days)
+    if base_model_df is not None:
+        model_df = ModelDFBuilder.append_model_df(base_model_df, model_df)
+
+    return write_model_df(model_df, f'{model_data_s3_prefix}/resolution={resolution_days}/data', feather)
+
+
+def get_incremental_training_data(training_data, parent_model_s3_uri, parent_train_end_date=None):
+    """
+    Loads the parent model of an incremental training run and keeps only the training rows
+    after the parent's training data.
+
+    Parameters:
+    - training_data: X_train, y_train, X_test, y_test in time order.
+    - parent_model_s3_uri: S3 URI of the pickled parent model.
+    - parent_train_end_date: last date the parent was trained on (by default from its lineage).
+
+    Returns:
+    - The parent model, its lineage (with its version), and the training data to continue on.
+    """
+    if is_compiled_ensemble(parent_model_s3_uri):
+        raise ValueError("Compiled models can't be trained further; use the parent's model.pkl.")
 
-    output_s3_uri = f's3://{os.environ["OUTPUT_BUCKET"]}/model_data/location={location_name}/run_timestamp={run_timestamp}/resolution={resolution_days}.parquet'
+    parent_bucket, parent_key = get_bucket_and_key_from_s3_uri(parent_model_s3_uri)
+    parent_model = model_s3_interface.load_model_from_s3(bucket_name=parent_bucket, s3_key=parent_key)
+    parent_lineage = model_s3_interface.load_model_lineage(parent_bucket, parent_key) or {}
+    parent_lineage = {
+        **parent_lineage,
+        'model_s3_uri': parent_model_s3_uri,
+        'model_version': model_s3_interface.get_model_version(parent_bucket, parent_key)
+    }
+
+    parent_train_end_date = parent_train_end_date or parent_lineage.get('train_end_date')
+    if parent_train_end_date is None:
+        raise ValueError(f"{parent_model_s3_uri} has no lineage; set parent_train_end_date.")
 
-    wr.s3.to_parquet(model_df, path=output_s3_uri, index=False)
+    X_train, y_train, X_test, y_test = training_data
+    # Training rows are in time order, so the new ones are a slice
+    start = X_train.index.searchsorted(pd.Timestamp(parent_train_end_date), side='right')
+    if start == len(X_train):
+        raise ValueError(f"No training rows after {parent_train_end_date} to continue training on.")
 
-    return output_s3_uri
+    return parent_model, parent_lineage, (X_train.iloc[start:], y_train.iloc[start:], X_test, y_test)
 
 
 @log_invocation_details
 def model_trainer(event, context):
-    model_data_df = wr.s3.read_parquet(event['model_data_s3_uri'])
+    model_data_s3_uri = event['model_data_s3_uri']
     model_type = event.get('model_type', 'random_forest')
 
     model_params = event.get('model_params', {})
@@ -61,20 +178,83 @@ def model_trainer(event, context):
         model_type=model_type,
         model_params=model_params
     )
-    model, prediction_results_df, metrics = this_model_trainer.train_and_evaluate(
-        df=model_data_df,
-        target_col='outcome_of_int',
-        test_split_date=event['test_split_date'],
-        features=event.get('features', None)
-    )
+    if is_model_data_artifact(model_data_s3_uri):
+        training_data = this_model_trainer.split_model_data(
+            model_data=read_model_data_artifact(model_data_s3_uri),
+            test_split_date=event['test_split_date'],
+            features=event.get('features', None)
+        )
+    else:
+        training_data = this_model_trainer.split_df(
+            df=wr.s3.read_parquet(model_data_s3_uri),
+            target_col='outcome_of_int',
+            test_split_date=event['test_split_date'],
+            features=event.get('features', None)
+        )
+
+    # Incremental training continues the parent model on the rows it wasn't trained on
+    parent_model = parent_lineage = None
+    if event.get('parent_model_s3_uri'):
+        if event.get('param_grid') or event.get('param_distributions'):
+            raise ValueError("Parameter sweeps train from scratch; they can't be combined with parent_model_s3_uri.")
+        parent_model, parent_lineage, training_data = get_incremental_training_data(
+            training_data, event['parent_model_s3_uri'], event.get('parent_train_end_date')
+        )
+        logger.info(f"Continuing {event['parent_model_s3_uri']} on {len(training_data[0])} new training rows")
+
+    prediction_results_prefix = f"s3://{os.environ['MODEL_BUCKET']}/prediction_results/location={event['location_name']}/run_timestamp={event['run_timestamp']}"
+    if event.get('param_grid') or event.get('param_distributions'):
+        # Parameter sweep with time-series cross-validation on the training data; model_params
+        # are the defaults every candidate overrides
+        model, prediction_results_df, metrics, leaderboard_df = this_model_trainer.sweep_and_evaluate(
+            *training_data,
+            param_grid=event.get('param_grid'),
+            param_distributions=event.get('param_distributions'),
+            n_iter=event.get('n_iter', 10),
+            n_splits=event.get('cv_splits', 5),
+            gap=event.get('cv_gap', 0),
+            scoring=event.get('scoring', 'RMSE'),
+            workers=event.get('sweep_workers', 1),
+            random_state=event.get('random_state')
+        )
+        logger.info(f"Sweep leaderboard:\n{leaderboard_df.head(10).to_string()}")
+        wr.s3.to_parquet(leaderboard_df, path=f"{prediction_results_prefix}/leaderboard.parquet", index=False)
+    else:
+        model, prediction_results_df, metrics = this_model_trainer.fit_and_evaluate(*training_data, parent_model=parent_model)
 
     logger.info(f"Model metrics: {metrics}")
-    model_s3_interface.save_model_to_s3(
+    model_prefix = f"models/{event['location_name']}/{event['run_timestamp']}/model_type={model_type}"
+    model_version = model_s3_interface.save_model_to_s3(
         model=model,
         bucket_name=os.environ["MODEL_BUCKET"],
-        s3_key=f"models/{event['location_name']}/{event['run_timestamp']}/model_type={model_type}/model.pkl"
+        s3_key=f"{model_prefix}/model.pkl"
     )
-    prediction_results_s3_uri = f"s3://{os.environ['MODEL_BUCKET']}/prediction_results/location={event['location_name']}/run_timestamp={event['run_timestamp']}/results.parquet"
+    logger.info(f"Saved model version {model_version}")
+
+    X_train = training_data[0]
+    model_s3_interface.save_model_lineage({
+        'model_s3_uri': f"s3://{os.environ['MODEL_BUCKET']}/{model_prefix}/model.pkl",
+        'model_version': model_version,
+        'model_type': model_type,
+        'model_params': model_params,
+        'model_data_s3_uri': model_data_s3_uri,
+        'train_start_date': X_train.index.min().isoformat(),
+        'train_end_date': X_train.index.max().isoformat(),
+        'training_rows': len(X_train),
+        'parent_model_s3_uri': parent_lineage and parent_lineage['model_s3_uri'],
+        'parent_model_version': parent_lineage and parent_lineage['model_version'],
+        # Every model this one was trained from, oldest first
+        'ancestors': [] if parent_lineage is None else parent_lineage.get('ancestors', []) + [{
+            'model_s3_uri': parent_lineage['model_s3_uri'],
+            'model_version': parent_lineage['model_version']
+        }],
+    }, bucket_name=os.environ["MODEL_BUCKET"], s3_key=f"{model_prefix}/model.pkl")
+    if event.get('compile_model', False):
+        # Flattened node arrays next to the pickle, for the runners to memory-map
+        compiled_model = CompiledEnsemble.from_model(model)
+        compiled_model_s3_uri = compiled_model.write(f"s3://{os.environ['MODEL_BUCKET']}/{model_prefix}/model.arrow")
+        logger.info(f"Saved compiled model with {compiled_model.node_count} nodes to {compiled_model_s3_uri}")
+    prediction_results_s3_uri = f"{prediction_results_prefix}/results.parquet"
     wr.s3.to_parquet(prediction_results_df, path=prediction_results_s3_uri, index=False)
 
     return {
@@ -92,19 +272,21 @@ def model_runner(event, context):
 
     # Read model_data_df from S3
     logger.info(f"Reading model_data_df from {model_data_s3_uri}")
-    model_data_df = wr.s3.read_parquet(model_data_s3_uri)
+    if is_model_data_artifact(model_data_s3_uri):
+        # Memory-mapped feature matrix, without the target
+        model_data_df = read_model_data_artifact(model_data_s3_uri).features
+    else:
+        model_data_df = wr.s3.read_parquet(model_data_s3_uri)
 
     # Read the model from S3
     logger.info(f"Loading model from {model_s3_uri}")
-    model_bucket, model_key = get_bucket_and_key_from_s3_uri(model_s3_uri)
-    model = model_s3_interface.load_model_from_s3(
-        bucket_name=model_bucket,
-        s3_key=model_key
-    )
+    model = load_model(model_s3_uri)
 
     # Predict outcome_of_int
     logger.info("Generating predictions")
-    y_pred = model.predict(model_data_df.drop(columns=['outcome_of_int'], errors='ignore'))
+    if 'outcome_of_int' in model_data_df.columns:
+        model_data_df = model_data_df.drop(columns=['outcome_of_int'])
+    y_pred = model.predict(model_data_df)
 
     # Save predictions to S3
     model_prefix = model_s3_uri.replace('/model.joblib', '')
@@ -124,3 +306,134 @@ def model_runner(event, context):
             "predictions_s3_uri": output_s3_uri
         })
     }
+
+
+def read_batch_manifest(event):
+    if 'manifest_s3_uri' in event:
+        bucket, key = get_bucket_and_key_from_s3_uri(event['manifest_s3_uri'])
+        return json.loads(model_s3_interface.get_s3_client().get_object(Bucket=bucket, Key=key)['Body'].read())
+    return event['jobs']
+
+
+def get_location_model_dfs(location_jobs, arrow=False):
+    """
+    Builds the model data of one location once for all of its jobs: the daily features for the
+    union of the jobs' date ranges, and every resolution the jobs ask for.
+
+    Jobs with a prebuilt `model_data_s3_uri` are scored on it as is, so they can't ask for
+    another resolution.
+
+    Returns:
+    - Model data by resolution days.
+    """
+    location_name = location_jobs[0]['location_name']
+    for key in ['model_data_s3_uri', 'observation_s3_uris_by_station_id']:
+        if any(job.get(key) != location_jobs[0].get(key) for job in location_jobs):
+            raise ValueError(f"Jobs for {location_name} have different {key} values; they must agree.")
+
+    model_data_s3_uri = location_jobs[0].get('model_data_s3_uri')
+    if model_data_s3_uri:
+        if any(int(job.get('resolution_days', 1)) != 1 for job in location_jobs):
+            raise ValueError(f"Jobs for {location_name} use prebuilt model data, which can't be scored at resolution_days other than 1.")
+        if is_model_data_artifact(model_data_s3_uri):
+            return {1: read_model_data_artifact(model_data_s3_uri).features}
+        return {1: wr.s3.read_parquet(model_data_s3_uri)}
+
+    outcome_df = pd.DataFrame(
+        columns=['outcome_of_int'],
+        index=pd.date_range(
+            start=min(pd.to_datetime(job['start_date']) for job in location_jobs),
+            end=max(pd.to_datetime(job['end_date']) for job in location_jobs),
+            freq='D'
+        )
+    )
+    model_df_builder = get_model_df_builder(outcome_df, location_jobs[0]['observation_s3_uris_by_station_id'], arrow=arrow)
+    resolutions = sorted({int(job.get('resolution_days', 1)) for job in location_jobs})
+    return model_df_builder.build_model_dfs(resolutions=resolutions)
+
+
+def score_batch_job(job, model, model_dfs_by_location):
+    model_df = model_dfs_by_location[job['location_name']][int(job.get('resolution_days', 1))]
+    if isinstance(model_df.index, pd.DatetimeIndex):
+        model_df = model_df.loc[pd.to_datetime(job['start_date']):pd.to_datetime(job['end_date'])]
+
+    # Select and order the columns the model was fitted on
+    feature_names = getattr(model, 'feature_names_in_', None)
+    if feature_names is not None:
+        X = model_df[list(feature_names)]
+    elif 'outcome_of_int' in model_df.columns:
+        X = model_df.drop(columns=['outcome_of_int'])
+    else:
+        X = model_df
+
+    return pd.DataFrame({
+        'date': model_df.index,
+        'location_name': job['location_name'],
+        'model_s3_uri': job['model_s3_uri'],
+        'resolution_days': int(job.get('resolution_days', 1)),
+        'y_pred': model.predict(X)
+    })
+
+
+@log_invocation_details
+def batch_model_runner(event, context):
+    """
+    Scores a manifest of (location, model, date range) jobs in one invocation.
+
+    Each location's features are built once for all of its jobs (covering their combined date
+    range), jobs are grouped by model so each model is loaded once, and the groups are scored
+    concurrently. All predictions are written as one dataset partitioned by location.
+
+    Args:
+        event (dict): Contains `run_timestamp` and either `jobs` or `manifest_s3_uri` (a JSON list of
+            jobs in S3), and optionally `workers` and `arrow`. Each job has `location_name`,
+            `model_s3_uri`, `start_date`, `end_date`, optionally `resolution_days`, and either
+            `observation_s3_uris_by_station_id` or a prebuilt `model_data_s3_uri`. Jobs of one
+            location share its observations.
+
+    Returns:
+        dict: The predictions S3 URI and the number of jobs and predictions.
+    """
+    jobs = read_batch_manifest(event)
+    workers = event.get('workers')
+
+    jobs_by_location = {}
+    jobs_by_model = {}
+    for job in jobs:
+        jobs_by_location.setdefault(job['location_name'], []).append(job)
+        jobs_by_model.setdefault(job['model_s3_uri'], []).append(job)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        model_dfs_futures = {
+            location_name: executor.submit(get_location_model_dfs, location_jobs, event.get('arrow', False))
+            for location_name, location_jobs in jobs_by_location.items()
+        }
+        model_futures = {
+            model_s3_uri: executor.submit(load_model, model_s3_uri)
+            for model_s3_uri in jobs_by_model
+        }
+        model_dfs_by_location = {location_name: future.result() for location_name, future in model_dfs_futures.items()}
+        logger.info(f"Built model data for {len(model_dfs_by_location)} locations")
+
+        prediction_futures = [
+            executor.submit(score_batch_job, job, model_futures[model_s3_uri].result(), model_dfs_by_location)
+            for model_s3_uri, model_jobs in jobs_by_model.items()
+            for job in model_jobs
+        ]
+        predictions_df = pd.concat([future.result() for future in prediction_futures], ignore_index=True)
+
+    output_s3_uri = f"s3://{os.environ['MODEL_BUCKET']}/batch_predictions/run_timestamp={event['run_timestamp']}/"
+    logger.info(f"Saving {len(predictions_df)} predictions for {len(jobs)} jobs to {output_s3_uri}")
+    wr.s3.to_parquet(
+        predictions_df,
+        path=output_s3_uri,
+        dataset=True,
+        partition_cols=['location_name'],
+        mode='overwrite_partitions'
+    )
+
+    return {
+        'predictions_s3_uri': output_s3_uri,
+        'jobs': len(jobs),
+        'predictions': len(predictions_df)
+    }
@@ -1,51 +1,219 @@
-import boto3
-import pickle
+import hashlib
+import json
 import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import boto3
+from botocore.exceptions import ClientError
+import pyarrow as pa
+
+
+COMPRESSION = "zstd"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+CONTENT_HASH_METADATA_KEY = "content-sha256"
+PICKLED_SIZE_METADATA_KEY = "pickled-size"
+DEFAULT_MODEL_CACHE_MAX_BYTES = 512 << 20
+LINEAGE_FILE_NAME = "lineage.json"
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    One S3 client per process, reused across warm invocations (clients are thread-safe once
+    created, but creating them is not).
+    """
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client("s3")
+    return _s3_client
+
+
+def serialize_model(model):
+    """
+    Pickles and zstd-compresses a model in memory.
+
+    Returns:
+    - The compressed bytes and the size of the pickle.
+    """
+    sink = pa.BufferOutputStream()
+    with pa.CompressedOutputStream(sink, COMPRESSION) as stream:
+        pickle.dump(model, stream, protocol=pickle.HIGHEST_PROTOCOL)
+        pickled_size = stream.tell()
+    return sink.getvalue().to_pybytes(), pickled_size
+
+
+def deserialize_model(payload):
+    # Models saved before compression was added are plain pickles
+    if not payload.startswith(ZSTD_MAGIC):
+        return pickle.loads(payload)
+    return pickle.load(pa.CompressedInputStream(pa.BufferReader(payload), COMPRESSION))
+
+
+class ModelCache:
+    """
+    Thread-safe LRU cache of deserialized models by content hash, bounded by the models'
+    pickled sizes. Kept at module level, so models survive across warm Lambda invocations.
+    """
+    def __init__(self, max_bytes=DEFAULT_MODEL_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.models = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, content_hash):
+        with self.lock:
+            entry = self.models.get(content_hash)
+            if entry is None:
+                return None
+            self.models.move_to_end(content_hash)
+            return entry[0]
+
+    def put(self, content_hash, model, size):
+        with self.lock:
+            if content_hash in self.models:
+                self.models.move_to_end(content_hash)
+                return
+            if size > self.max_bytes:
+                return
+
+            self.models[content_hash] = (model, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.models.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            self.total_bytes = 0
+
+
+model_cache = ModelCache(int(os.environ.get("MODEL_CACHE_MAX_BYTES", DEFAULT_MODEL_CACHE_MAX_BYTES)))
+
+# One lock per model key, so concurrent loads of the same model download and unpickle it once
+_key_locks = {}
+_key_locks_lock = threading.Lock()
+
+
+def get_key_lock(bucket_name, s3_key):
+    with _key_locks_lock:
+        return _key_locks.setdefault((bucket_name, s3_key), threading.Lock())
 
 
 def save_model_to_s3(model, bucket_name, s3_key):
     """
-    Saves a model to S3 using pickle.
+    Saves a model to S3 as a zstd-compressed pickle, streamed from memory.
 
     Parameters:
     - model: The trained model to save.
     - bucket_name: The name of the S3 bucket.
     - s3_key: The S3 key (path) where the model will be saved.
+
+    Returns:
+    - The model's version: the SHA-256 of the stored bytes, also kept in the object's metadata.
     """
-    # Serialize the model to a temporary file
-    temp_file = "/tmp/model.pkl"
-    with open(temp_file, "wb") as f:
-        pickle.dump(model, f)
+    payload, pickled_size = serialize_model(model)
+    content_hash = hashlib.sha256(payload).hexdigest()
+
+    get_s3_client().put_object(
+        Bucket=bucket_name,
+        Key=s3_key,
+        Body=payload,
+        Metadata={CONTENT_HASH_METADATA_KEY: content_hash, PICKLED_SIZE_METADATA_KEY: str(pickled_size)}
+    )
+    model_cache.put(content_hash, model, pickled_size)
 
-    # Upload the file to S3
-    s3_client = boto3.client("s3")
-    s3_client.upload_file(temp_file, bucket_name, s3_key)
+    return content_hash
 
-    # Clean up the temporary file
-    os.remove(temp_file)
 
+def get_model_version(bucket_name, s3_key):
+    """
+    The stored model's content hash, from its metadata (or its ETag for models saved without one).
+    """
+    head = get_s3_client().head_object(Bucket=bucket_name, Key=s3_key)
+    return head["Metadata"].get(CONTENT_HASH_METADATA_KEY) or head["ETag"].strip('"')
 
-def load_model_from_s3(bucket_name, s3_key):
+
+def load_model_from_s3(bucket_name, s3_key, use_cache=True):
     """
-    Loads a model from S3 using pickle.
+    Loads a model from S3.
+
+    The object's content hash is read from its metadata first (falling back to its ETag for models
+    saved without one), and a model with the same hash that is already in the process's cache is
+    returned without downloading or unpickling it again.
 
     Parameters:
     - bucket_name: The name of the S3 bucket.
     - s3_key: The S3 key (path) where the model is saved.
+    - use_cache: Look up and add to the in-process model cache.
 
     Returns:
     - The deserialized model.
     """
-    # Download the file from S3 to a temporary location
-    temp_file = "/tmp/model.pkl"
-    s3_client = boto3.client("s3")
-    s3_client.download_file(bucket_name, s3_key, temp_file)
+    s3_client = get_s3_client()
+    with get_key_lock(bucket_name, s3_key):
+        if use_cache:
+            model = model_cache.get(get_model_version(bucket_name, s3_key))
+            if model is not None:
+                return model
 
-    # Load the model from the file
-    with open(temp_file, "rb") as f:
-        model = pickle.load(f)
+        response = s3_client.get_object(Bucket=bucket_name, Key=s3_key)
+        payload = response["Body"].read()
+        metadata = response["Metadata"]
 
-    # Clean up the temporary file
-    os.remove(temp_file)
+        content_hash = metadata.get(CONTENT_HASH_METADATA_KEY)
+        if content_hash is not None and hashlib.sha256(payload).hexdigest() != content_hash:
+            raise ValueError(f"s3://{bucket_name}/{s3_key} doesn't match its content hash {content_hash}.")
+
+        model = deserialize_model(payload)
+        if use_cache:
+            version = content_hash or response["ETag"].strip('"')
+            model_cache.put(version, model, int(metadata.get(PICKLED_SIZE_METADATA_KEY, len(payload))))
 
     return model
+
+
+def get_lineage_key(s3_key):
+    # Kept next to the model it describes
+    return f"{s3_key.rsplit('/', 1)[0]}/{LINEAGE_FILE_NAME}"
+
+
+def save_model_lineage(lineage, bucket_name, s3_key):
+    """
+    Saves a model's lineage record (what it was trained on and from which parent) next to it.
+
+    Parameters:
+    - lineage: JSON-serializable dict.
+    - bucket_name: The name of the S3 bucket.
+    - s3_key: The S3 key of the model the record describes.
+    """
+    lineage_key = get_lineage_key(s3_key)
+    get_s3_client().put_object(
+        Bucket=bucket_name,
+        Key=lineage_key,
+        Body=json.dumps(lineage, indent=2, default=str).encode(),
+        ContentType="application/json"
+    )
+    return lineage_key
+
+
+def load_model_lineage(bucket_name, s3_key):
+    """
+    Loads the lineage record saved next to a model.
+
+    Returns:
+    - The lineage dict, or None for models saved without one.
+    """
+    try:
+        response = get_s3_client().get_object(Bucket=bucket_name, Key=get_lineage_key(s3_key))
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+
+    return json.loads(response["Body"].read())
@@ -1,8 +1,122 @@
-# from xgboost import XGBRegressor
+import copy
+import json
+import math
+import os
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import xgboost as xgb
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
+from sklearn.model_selection import ParameterGrid, ParameterSampler, TimeSeriesSplit
+import numpy as np
 import pandas as pd
 
+from model_data_artifact import ModelData, read_model_data_artifact, write_model_data_artifact
+
+
+# Whether a higher value of each metric is better, for ranking sweep candidates
+GREATER_IS_BETTER = {"RMSE": False, "MAE": False, "R2": True}
+
+# XGBoost defaults; model_params override them. Besides booster parameters, model_params may set
+# n_estimators (maximum boosting rounds), early_stopping_rounds, and validation_fraction (the
+# latest share of the training rows held out for early stopping).
+XGBOOST_DEFAULT_PARAMS = {
+    "tree_method": "hist",
+    "objective": "reg:squarederror",
+    "n_estimators": 1000,
+    "early_stopping_rounds": 50,
+    "validation_fraction": 0.1,
+}
+# sklearn-style names accepted in model_params for their native XGBoost parameters
+XGBOOST_PARAM_ALIASES = {"n_jobs": "nthread", "random_state": "seed"}
+# Trees added to a random forest by incremental training, unless model_params set n_estimators
+RANDOM_FOREST_INCREMENTAL_ESTIMATORS = 10
+
+
+def get_metrics(y_true, y_pred):
+    return {
+        "RMSE": mean_squared_error(y_true, y_pred),
+        "MAE": mean_absolute_error(y_true, y_pred),
+        "R2": r2_score(y_true, y_pred)
+    }
+
+
+def get_time_series_folds(n_rows, n_splits=5, test_size=None, gap=0):
+    """
+    Expanding-window folds over time-ordered rows: each fold trains on every row before its
+    test window (less `gap` rows), so no fold ever trains on the future.
+
+    Returns:
+    - List of (train_stop, test_start, test_stop) row positions; the train rows are [0, train_stop).
+    """
+    splitter = TimeSeriesSplit(n_splits=n_splits, test_size=test_size, gap=gap)
+    return [
+        (int(train[-1]) + 1, int(test[0]), int(test[-1]) + 1)
+        for train, test in splitter.split(np.empty((n_rows, 1)))
+    ]
+
+
+# Sweep data of a worker process, memory-mapped once by _init_sweep_worker, and the XGBoost
+# matrices built from it, by fold
+_sweep_model_data = None
+_sweep_dmatrix_caches = defaultdict(dict)
+
+
+def _init_sweep_worker(artifact_path):
+    global _sweep_model_data
+    _sweep_model_data = read_model_data_artifact(artifact_path)
+
+
+def _evaluate_candidate(model_type, params, folds, model_data=None, dmatrix_caches=None, default_params=None):
+    """
+    Fits one candidate on every fold and returns its per-fold metrics and total fit time.
+    Runs in a sweep worker (on the worker's shared data) or in process (on `model_data`).
+    `default_params` (e.g. the worker's thread count) apply unless the candidate sets them.
+    """
+    if model_data is None:
+        model_data, dmatrix_caches = _sweep_model_data, _sweep_dmatrix_caches
+    trainer = ModelTrainer(model_type=model_type, model_params={**(default_params or {}), **params})
+
+    fold_metrics = []
+    fit_seconds = 0.0
+    for fold, (train_stop, test_start, test_stop) in enumerate(folds):
+        train_data = model_data.slice(0, train_stop)
+        test_data = model_data.slice(test_start, test_stop)
+
+        started = time.perf_counter()
+        model = trainer.fit(train_data.features, train_data.target, dmatrix_cache=dmatrix_caches[fold])
+        fit_seconds += time.perf_counter() - started
+
+        fold_metrics.append(get_metrics(test_data.target, model.predict(test_data.features)))
+
+    return fold_metrics, fit_seconds
+
+
+class XGBoostModel:
+    """
+    A booster trained by ModelTrainer, with the predict interface of the sklearn models. Only the
+    trees up to the best early-stopping iteration are used.
+    """
+    def __init__(self, booster, best_iteration):
+        self.booster = booster
+        self.best_iteration = best_iteration
+
+    @property
+    def feature_names_in_(self):
+        # Named like the sklearn attribute, so callers can align features for either model type
+        return self.booster.feature_names
+
+    def predict(self, X):
+        # Predicts straight from the array, without building a DMatrix. DataFrames are passed as
+        # arrays in the booster's feature order, since converting them costs far more than
+        # predicting for a few rows.
+        if isinstance(X, pd.DataFrame) and self.feature_names_in_ is not None:
+            X = X[self.feature_names_in_].to_numpy()
+        return self.booster.inplace_predict(X, iteration_range=(0, self.best_iteration + 1))
+
 
 class ModelTrainer:
     def __init__(self, model_type="xgboost", model_params=None):
@@ -31,40 +145,279 @@ class ModelTrainer:
         - results_df: pandas DataFrame with y_test and y_pred columns
         - metrics: dict, evaluation metrics (RMSE, MAE, R²)
         """
+        return self.fit_and_evaluate(*self.split_df(df, target_col, test_split_date, features))
+
+    def train_and_evaluate_model_data(self, model_data, test_split_date, features=None):
+        """
+        Trains and evaluates on a memory-mapped model data artifact (see model_data_artifact).
+        The train and test sets are views of the artifact's feature matrix, so nothing is copied
+        before the estimator's own input conversion.
+
+        Parameters:
+        - model_data: model_data_artifact.ModelData with a target
+        - test_split_date: ISO string for split point
+        - features: list of feature columns to use (defaults to all)
+
+        Returns:
+        - Same as train_and_evaluate.
+        """
+        return self.fit_and_evaluate(*self.split_model_data(model_data, test_split_date, features))
+
+    @staticmethod
+    def split_df(df, target_col, test_split_date, features=None):
+        """
+        Returns:
+        - X_train, y_train, X_test, y_test split at test_split_date.
+        """
         train_df = df[df.index < test_split_date]
         test_df = df[df.index >= test_split_date]
 
         if features is None:
             features = [c for c in df.columns if c != target_col]
 
-        X_train, y_train = train_df[features], train_df[target_col]
-        X_test, y_test = test_df[features], test_df[target_col]
+        return train_df[features], train_df[target_col], test_df[features], test_df[target_col]
+
+    @staticmethod
+    def split_model_data(model_data, test_split_date, features=None):
+        """
+        Returns:
+        - X_train, y_train, X_test, y_test split at test_split_date, as views of `model_data`.
+        """
+        train_data, test_data = model_data.split(test_split_date)
+        X_train, X_test = train_data.features, test_data.features
+        if features is not None:
+            X_train, X_test = X_train[features], X_test[features]
 
+        return X_train, train_data.target, X_test, test_data.target
+
+    def make_model(self):
         # Initialize the model
-        if self.model_type == "xgboost":
-            raise NotImplementedError("XGBoost model training is not implemented in this example.")
-            # model = XGBRegressor(**self.model_params)
-        elif self.model_type == "random_forest":
-            model = RandomForestRegressor(**self.model_params)
+        if self.model_type == "random_forest":
+            return RandomForestRegressor(**self.model_params)
         else:
             raise ValueError("Invalid model_type. Choose 'xgboost' or 'random_forest'.")
 
-        # Train the model
+    def fit(self, X_train, y_train, dmatrix_cache=None, parent_model=None):
+        """
+        Trains the model.
+
+        Parameters:
+        - X_train, y_train: training data in time order.
+        - dmatrix_cache: dict reused across fits on the same X_train and y_train (e.g. by the
+          candidates of a sweep), so XGBoost's quantized matrices are built once per dataset.
+        - parent_model: a model trained earlier to continue training on X_train and y_train
+          (see extend_random_forest and fit_xgboost) instead of training one from scratch. It
+          is not modified.
+
+        Returns:
+        - The trained model.
+        """
+        if parent_model is not None:
+            # Trees are split on feature positions, so the new data must be in the parent's column order
+            X_train = X_train[list(parent_model.feature_names_in_)]
+
+        if self.model_type == "xgboost":
+            return self.fit_xgboost(X_train, y_train, dmatrix_cache, parent_model)
+
+        model = self.make_model() if parent_model is None else self.extend_random_forest(parent_model)
         model.fit(X_train, y_train)
+        return model
+
+    def extend_random_forest(self, parent_model):
+        """
+        A copy of a fitted forest set to warm start, so fitting it adds n_estimators trees
+        (RANDOM_FOREST_INCREMENTAL_ESTIMATORS by default) to the parent's. The copy shares the
+        parent's trees, which are never refit; other model_params apply to the new trees.
+        """
+        if self.model_type != "random_forest":
+            raise ValueError(f"Can't continue training a random forest as {self.model_type}.")
+
+        params = dict(self.model_params)
+        added_estimators = params.pop("n_estimators", RANDOM_FOREST_INCREMENTAL_ESTIMATORS)
+
+        model = copy.copy(parent_model)
+        model.estimators_ = list(parent_model.estimators_)
+        model.set_params(**params, warm_start=True, n_estimators=len(parent_model.estimators_) + added_estimators)
+        return model
+
+    def get_xgboost_params(self):
+        params = {**XGBOOST_DEFAULT_PARAMS, **self.model_params}
+        return {XGBOOST_PARAM_ALIASES.get(name, name): value for name, value in params.items()}
+
+    def fit_xgboost(self, X_train, y_train, dmatrix_cache=None, parent_model=None):
+        """
+        Trains XGBoost with the histogram tree method. The latest `validation_fraction` of the
+        training rows is held out, and boosting stops once the validation error hasn't improved
+        for `early_stopping_rounds` rounds. Training and validation data are quantized once into
+        QuantileDMatrix objects (the validation matrix with the training bins), which hist trains
+        on directly.
+
+        With a parent_model (an XGBoostModel), boosting continues from the parent's trees up to
+        its best iteration, for at most n_estimators more rounds.
+        """
+        xgb_model = None
+        if parent_model is not None:
+            if self.model_type != "xgboost" or not isinstance(parent_model, XGBoostModel):
+                raise ValueError(f"Can't continue boosting a {type(parent_model).__name__} as {self.model_type}.")
+            # Slicing copies the booster, so the parent (possibly a cached, shared model) is untouched
+            xgb_model = parent_model.booster[:parent_model.best_iteration + 1]
+
+        params = self.get_xgboost_params()
+        num_boost_round = params.pop("n_estimators")
+        early_stopping_rounds = params.pop("early_stopping_rounds")
+        validation_fraction = params.pop("validation_fraction")
+
+        validation_rows = 0
+        if early_stopping_rounds and validation_fraction:
+            validation_rows = min(max(math.ceil(len(X_train) * validation_fraction), 1), len(X_train) - 1)
+        fit_rows = len(X_train) - validation_rows
+
+        dmatrix_cache = {} if dmatrix_cache is None else dmatrix_cache
+        cache_key = (validation_rows, params.get("max_bin", 256))
+        if cache_key not in dmatrix_cache:
+            dtrain = xgb.QuantileDMatrix(X_train.iloc[:fit_rows], y_train.iloc[:fit_rows], max_bin=cache_key[1])
+            dvalidation = None
+            if validation_rows:
+                dvalidation = xgb.QuantileDMatrix(X_train.iloc[fit_rows:], y_train.iloc[fit_rows:], ref=dtrain)
+            dmatrix_cache[cache_key] = (dtrain, dvalidation)
+        dtrain, dvalidation = dmatrix_cache[cache_key]
+
+        booster = xgb.train(
+            params,
+            dtrain,
+            num_boost_round=num_boost_round,
+            evals=[(dvalidation, "validation")] if dvalidation is not None else (),
+            early_stopping_rounds=early_stopping_rounds if dvalidation is not None else None,
+            verbose_eval=False,
+            xgb_model=xgb_model
+        )
+        best_iteration = booster.best_iteration if dvalidation is not None else booster.num_boosted_rounds() - 1
+        return XGBoostModel(booster, best_iteration)
+
+    def fit_and_evaluate(self, X_train, y_train, X_test, y_test, parent_model=None):
+        # Train the model
+        model = self.fit(X_train, y_train, parent_model=parent_model)
+
+        prediction_results_df, metrics = self.evaluate(model, X_test, y_test)
+        return model, prediction_results_df, metrics
 
+    @staticmethod
+    def evaluate(model, X_test, y_test):
         # Make predictions
         y_pred = model.predict(X_test)
 
-        # Calculate metrics
-        metrics = {
-            "RMSE": mean_squared_error(y_test, y_pred),
-            "MAE": mean_absolute_error(y_test, y_pred),
-            "R2": r2_score(y_test, y_pred)
-        }
-
         prediction_results_df = pd.DataFrame({
             "y_test": y_test,
             "y_pred": y_pred
-        }, index=test_df.index)
+        }, index=X_test.index)
 
-        return model, prediction_results_df, metrics
+        return prediction_results_df, get_metrics(y_test, y_pred)
+
+    def get_sweep_candidates(self, param_grid=None, param_distributions=None, n_iter=10, random_state=None):
+        """
+        Candidate parameters: every combination of `param_grid`, or `n_iter` samples of
+        `param_distributions` (lists are sampled uniformly, scipy distributions with rvs), each
+        applied over the trainer's model_params.
+        """
+        if param_grid is not None:
+            candidates = ParameterGrid(param_grid)
+        elif param_distributions is not None:
+            candidates = ParameterSampler(param_distributions, n_iter=n_iter, random_state=random_state)
+        else:
+            raise ValueError("Provide either param_grid or param_distributions.")
+
+        return [{**self.model_params, **candidate} for candidate in candidates]
+
+    def sweep(self, X, y, param_grid=None, param_distributions=None, n_iter=10, n_splits=5, test_size=None,
+              gap=0, scoring="RMSE", workers=None, random_state=None):
+        """
+        Searches model parameters with expanding-window time-series cross-validation, then refits
+        the best candidate on all of X and y.
+
+        Candidates are fitted on a process pool. The feature matrix is written once to a temporary
+        model data artifact that every worker memory-maps, so the workers share one read-only copy
+        through the page cache instead of each being sent a pickled copy.
+
+        Parameters:
+        - X: features in time order (DataFrame).
+        - y: target aligned with X.
+        - param_grid: dict of parameter lists to search exhaustively.
+        - param_distributions: dict of lists or distributions to sample `n_iter` candidates from.
+        - n_splits, test_size, gap: folds as in sklearn's TimeSeriesSplit.
+        - scoring: metric candidates are ranked by (RMSE, MAE, or R2).
+        - workers: worker processes (defaults to the CPU count; 1 fits in this process, which is
+          required on AWS Lambda since it has no /dev/shm for the pool's queues).
+        - random_state: seed for sampling param_distributions.
+
+        Returns:
+        - The best model refit on X and y.
+        - Leaderboard DataFrame, best first, with each candidate's params, mean and standard
+          deviation of every metric across folds, and total fit seconds.
+        """
+        if scoring not in GREATER_IS_BETTER:
+            raise ValueError(f"Invalid scoring. Choose one of {list(GREATER_IS_BETTER)}.")
+
+        candidates = self.get_sweep_candidates(param_grid, param_distributions, n_iter, random_state)
+        folds = get_time_series_folds(len(X), n_splits=n_splits, test_size=test_size, gap=gap)
+        workers = workers or os.cpu_count() or 1
+        worker_params = None
+        if self.model_type == "xgboost" and workers > 1:
+            # Split the cores between the workers rather than every worker using all of them. Only
+            # the fold fits use this; the leaderboard and the final refit keep the candidate's params.
+            threads = max(1, (os.cpu_count() or 1) // min(workers, len(candidates)))
+            worker_params = {"n_jobs": threads}
+
+        if workers == 1 or len(candidates) == 1:
+            model_data = ModelData(X, pd.Series(np.asarray(y, dtype=np.float64), index=X.index))
+            dmatrix_caches = defaultdict(dict)
+            results = [
+                _evaluate_candidate(self.model_type, params, folds, model_data, dmatrix_caches, worker_params)
+                for params in candidates
+            ]
+        else:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                artifact_path = write_model_data_artifact(
+                    X.assign(outcome_of_int=np.asarray(y, dtype=np.float64)),
+                    os.path.join(temp_dir, 'sweep.feather')
+                )
+                with ProcessPoolExecutor(max_workers=min(workers, len(candidates)), initializer=_init_sweep_worker,
+                                         initargs=(artifact_path,)) as executor:
+                    futures = [
+                        executor.submit(_evaluate_candidate, self.model_type, params, folds, default_params=worker_params)
+                        for params in candidates
+                    ]
+                    results = [future.result() for future in futures]
+
+        rows = []
+        for candidate, (params, (fold_metrics, fit_seconds)) in enumerate(zip(candidates, results)):
+            fold_metrics_df = pd.DataFrame(fold_metrics)
+            rows.append({
+                "candidate": candidate,
+                "params": json.dumps(params, sort_keys=True, default=str),
+                **{f"mean_{metric}": fold_metrics_df[metric].mean() for metric in GREATER_IS_BETTER},
+                **{f"std_{metric}": fold_metrics_df[metric].std(ddof=0) for metric in GREATER_IS_BETTER},
+                "fit_seconds": fit_seconds
+            })
+
+        leaderboard_df = pd.DataFrame(rows).sort_values(
+            f"mean_{scoring}", ascending=not GREATER_IS_BETTER[scoring], kind="stable"
+        ).reset_index(drop=True)
+        leaderboard_df.insert(0, "rank", np.arange(1, len(leaderboard_df) + 1))
+
+        best_params = candidates[leaderboard_df.pop("candidate").iloc[0]]
+        best_model = ModelTrainer(model_type=self.model_type, model_params=best_params).fit(X, y)
+
+        return best_model, leaderboard_df
+
+    def sweep_and_evaluate(self, X_train, y_train, X_test, y_test, **sweep_kwargs):
+        """
+        Runs a sweep (see sweep) on the training data and evaluates the refit best model on the
+        test data.
+
+        Returns:
+        - The best model, the prediction results and metrics as in train_and_evaluate, and the
+          sweep leaderboard.
+        """
+        model, leaderboard_df = self.sweep(X_train, y_train, **sweep_kwargs)
+        prediction_results_df, metrics = self.evaluate(model, X_test, y_test)
+        return model, prediction_results_df, metrics, leaderboard_df
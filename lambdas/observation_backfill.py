@@ -0,0 +1,202 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict
+
+import awswrangler as wr
+import pandas as pd
+
+from observation_pipeline import process_observation_df
+from station_registry import consolidate_station_registry, get_station_record, write_station_record
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def get_station_id_from_path(path: str) -> str:
+    return path.split('/')[-1].split('.')[0]
+
+
+def list_station_files(source: str) -> Dict[str, str]:
+    """
+    Lists station observation files from a directory (local or S3 prefix) or a manifest.
+
+    A manifest is either a JSON object mapping station IDs to file paths, or a text file with
+    one path per line. Station IDs default to the file name without its extension.
+    """
+    if source.endswith('.json'):
+        with open(source) as f:
+            return json.load(f)
+
+    if source.endswith('.txt'):
+        with open(source) as f:
+            paths = [line.strip() for line in f if line.strip()]
+    elif source.startswith('s3://'):
+        paths = wr.s3.list_objects(source.rstrip('/') + '/', suffix=['.csv', '.parquet'])
+    else:
+        paths = sorted(glob.glob(os.path.join(source, '*.csv')) + glob.glob(os.path.join(source, '*.parquet')))
+
+    return {get_station_id_from_path(path): path for path in paths}
+
+
+def read_checkpoint(checkpoint_path: str) -> Dict[str, dict]:
+    """
+    Reads the records of stations that finished in earlier runs, keyed by station ID.
+    Failed stations are not returned so they are retried.
+    """
+    if not os.path.exists(checkpoint_path):
+        return {}
+
+    records = {}
+    with open(checkpoint_path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                records[record['station_id']] = record
+
+    return {station_id: r for station_id, r in records.items() if r['status'] != 'failed'}
+
+
+def write_checkpoint(checkpoint_file, record: dict):
+    checkpoint_file.write(json.dumps(record) + '\n')
+    checkpoint_file.flush()
+    os.fsync(checkpoint_file.fileno())
+
+
+def process_station_file(station_id: str, input_path: str, output_path: str,
+                         max_error_rate: float = None, typed: bool = False, registry_prefix: str = None) -> dict:
+    """
+    Runs the observation pipeline for one station file and writes the filtered observations.
+    Runs in a worker process, so it only takes and returns plain values.
+    """
+    if input_path.startswith('s3://'):
+        df = wr.s3.read_csv(input_path) if input_path.endswith('.csv') else wr.s3.read_parquet(input_path)
+    else:
+        df = pd.read_csv(input_path) if input_path.endswith('.csv') else pd.read_parquet(input_path)
+
+    if registry_prefix:
+        write_station_record(get_station_record(station_id, df), registry_prefix)
+
+    filtered_df, _, error_rate = process_observation_df(df, typed=typed)
+
+    record = {
+        'station_id': station_id,
+        'input_path': input_path,
+        'rows': len(df),
+        'error_rate': error_rate,
+    }
+    if max_error_rate is not None and error_rate > max_error_rate:
+        return {**record, 'status': 'rejected', 'output_path': None}
+
+    if output_path.startswith('s3://'):
+        wr.s3.to_parquet(filtered_df, path=output_path, index=True)
+    else:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        filtered_df.to_parquet(output_path)
+
+    return {**record, 'status': 'done', 'output_path': output_path}
+
+
+def backfill_observations(source: str, output_prefix: str, checkpoint_path: str, workers: int = None,
+                          max_error_rate: float = None, typed: bool = False, registry_prefix: str = None) -> dict:
+    """
+    Processes many station files in parallel, resuming from a checkpoint.
+
+    Parameters:
+    - source: directory, S3 prefix, or manifest of station files.
+    - output_prefix: local directory or S3 prefix; each station is written to
+      `{output_prefix}/station_id={station_id}/data.parquet`.
+    - checkpoint_path: local JSON-lines file recording every finished station.
+    - workers: number of worker processes (defaults to the number of cores).
+    - max_error_rate: stations above this error rate are recorded as rejected and not written.
+    - typed: format to ObservationFormatter.TYPED_SCHEMA dtypes.
+    - registry_prefix: local directory or S3 prefix of the station registry; when given, every
+      station's record is written and the registry is consolidated at the end.
+
+    Returns:
+    - A summary with station counts and stations/sec and rows/sec throughput.
+    """
+    station_files = list_station_files(source)
+    finished = read_checkpoint(checkpoint_path)
+    pending = {station_id: path for station_id, path in station_files.items() if station_id not in finished}
+    logger.info(f"{len(station_files)} stations found, {len(finished)} already finished, {len(pending)} to process")
+
+    counts = {'done': 0, 'rejected': 0, 'failed': 0}
+    rows = 0
+    start_time = time.perf_counter()
+    with open(checkpoint_path, 'a') as checkpoint_file, \
+            ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {
+            executor.submit(
+                process_station_file,
+                station_id,
+                input_path,
+                f"{output_prefix.rstrip('/')}/station_id={station_id}/data.parquet",
+                max_error_rate,
+                typed,
+                registry_prefix
+            ): station_id
+            for station_id, input_path in pending.items()
+        }
+        for future in as_completed(futures):
+            station_id = futures[future]
+            try:
+                record = future.result()
+                rows += record['rows']
+            except Exception as e:
+                logger.exception(f"Failed to process {station_id}")
+                record = {'station_id': station_id, 'input_path': pending[station_id], 'status': 'failed', 'error': str(e)}
+
+            counts[record['status']] += 1
+            write_checkpoint(checkpoint_file, record)
+
+            processed = sum(counts.values())
+            if processed % 100 == 0 or processed == len(pending):
+                elapsed = time.perf_counter() - start_time
+                logger.info(
+                    f"{processed}/{len(pending)} stations, "
+                    f"{processed / elapsed:.2f} stations/sec, {rows / elapsed:.0f} rows/sec"
+                )
+
+    if registry_prefix:
+        consolidate_station_registry(registry_prefix)
+
+    elapsed = time.perf_counter() - start_time
+    summary = {
+        **counts,
+        'skipped': len(finished),
+        'rows': rows,
+        'seconds': elapsed,
+        'stations_per_second': sum(counts.values()) / elapsed if elapsed else 0.0,
+        'rows_per_second': rows / elapsed if elapsed else 0.0,
+    }
+    logger.info(f"Backfill summary: {json.dumps(summary)}")
+
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Backfill observations for many stations in parallel.")
+    parser.add_argument('source', help="Directory, S3 prefix, or manifest (.json or .txt) of station files")
+    parser.add_argument('output_prefix', help="Local directory or S3 prefix for filtered observations")
+    parser.add_argument('--checkpoint', default='backfill_checkpoint.jsonl', help="Checkpoint file for resuming")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (defaults to core count)")
+    parser.add_argument('--max-error-rate', type=float, default=None, help="Reject stations above this error rate")
+    parser.add_argument('--typed', action='store_true', help="Write compact typed observations")
+    parser.add_argument('--registry-prefix', default=None, help="Station registry directory or S3 prefix to update")
+    args = parser.parse_args()
+
+    backfill_observations(
+        source=args.source,
+        output_prefix=args.output_prefix,
+        checkpoint_path=args.checkpoint,
+        workers=args.workers,
+        max_error_rate=args.max_error_rate,
+        typed=args.typed,
+        registry_prefix=args.registry_prefix
+    )
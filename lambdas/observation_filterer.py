@@ -3,13 +3,35 @@ import pandas as pd
 
 class ObservationFilterer:
     def __init__(self, df, validation_df=None):
+        """
+        Parameters:
+        - df: formatted observations.
+        - validation_df: either a boolean validity DataFrame covering every column of `df`, or the
+          compact bitmask flags from ObservationValidator.validate_flags (non-zero means invalid).
+        """
         self.df = df
         self.validation_df = validation_df
 
     def filter(self):
-        if self.validation_df is not None:
+        if self.validation_df is None:
+            filtered_df = self.df
+        # Flags without columns (nothing validated) go through filter_with_flags, which masks nothing
+        elif self.validation_df.shape[1] and all(pd.api.types.is_bool_dtype(dtype) for dtype in self.validation_df.dtypes):
             filtered_df = self.df.where(self.validation_df, other=pd.NA)
         else:
-            filtered_df = self.df
+            filtered_df = self.filter_with_flags()
+
+        return filtered_df
+
+    def filter_with_flags(self):
+        """
+        Masks invalid cells using bitmask flags, touching only the validated columns.
+        """
+        filtered_df = self.df.copy(deep=False)
+        flags = self.validation_df.reindex(self.df.index).to_numpy()
+        for i, col in enumerate(self.validation_df.columns):
+            invalid = flags[:, i] != 0
+            if invalid.any():
+                filtered_df[col] = self.df[col].where(~invalid, other=pd.NA)
 
         return filtered_df
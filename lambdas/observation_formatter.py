@@ -1,25 +1,72 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 
 
 class ObservationFormatter:
-    def __init__(self, df: pd.DataFrame):
-        self.df = df.copy()
+    # Output dtypes of the typed formatting mode. FRSHTT is packed into a bitfield with one bit
+    # per flag, read right to left (Tornado is bit 0, Fog is bit 5).
+    TYPED_SCHEMA = {
+        'TEMP': 'float32',
+        'DEWP': 'float32',
+        'MAX': 'float32',
+        'MIN': 'float32',
+        'SLP': 'float32',
+        'STP': 'float32',
+        'WDSP': 'float32',
+        'MXSPD': 'float32',
+        'GUST': 'float32',
+        'VISIB': 'float32',
+        'SNDP': 'float32',
+        'PRCP': 'float32',
+        'FRSHTT': 'UInt8',
+        'DATE': 'datetime64[ns]',
+    }
+    FRSHTT_FLAG_COUNT = 6
+    # Column types of the Arrow-backed mode, which formats like the typed mode into pyarrow-backed
+    # columns. Other columns are converted as they are, with strings dictionary encoded.
+    ARROW_SCHEMA = {
+        **{col: pa.float32() for col, dtype in TYPED_SCHEMA.items() if dtype == 'float32'},
+        'FRSHTT': pa.uint8(),
+    }
+
+    def __init__(self, df: pd.DataFrame, copy: bool = True, typed: bool = False, arrow: bool = False):
+        """
+        Parameters:
+        - df: raw observations.
+        - copy: copy `df` before formatting; pass False for frames the caller no longer needs.
+        - typed: emit the compact dtypes of TYPED_SCHEMA instead of float64 measurements,
+          zero-padded FRSHTT strings, and re-parsed date strings.
+        - arrow: emit pyarrow-backed columns (ARROW_SCHEMA) that are written to parquet
+          without conversion; implies `typed`.
+        """
+        self.df = df.copy() if copy else df
+        self.typed = typed or arrow
+        self.arrow = arrow
+
+        if arrow:
+            format_float, format_frshtt = self.format_arrow, self.format_arrow_frshtt
+        elif typed:
+            format_float, format_frshtt = self.format_typed, self.format_frshtt_bitfield
+        else:
+            format_float, format_frshtt = self.format_float, self.format_frshtt
+        format_date = self.format_typed_date if self.typed else self.format_date
 
         self.formatter_map = {
-            'TEMP': [self.format_float],
-            'DEWP': [self.format_float],
-            'MAX': [self.format_float],
-            'MIN': [self.format_float],
-            'SLP': [self.format_float],
-            'STP': [self.format_float],
-            'WDSP': [self.format_float],
-            'MXSPD': [self.format_float],
-            'GUST': [self.format_float, self.replace_value({'999.9': pd.NA})],
-            'VISIB': [self.format_float],
-            'SNDP': [self.format_float],
-            'PRCP': [self.format_float],
-            'FRSHTT': [self.format_frshtt],
-            'DATE': [self.format_date],
+            'TEMP': [format_float],
+            'DEWP': [format_float],
+            'MAX': [format_float],
+            'MIN': [format_float],
+            'SLP': [format_float],
+            'STP': [format_float],
+            'WDSP': [format_float],
+            'MXSPD': [format_float],
+            'GUST': [format_float, self.replace_value({'999.9': pd.NA})],
+            'VISIB': [format_float],
+            'SNDP': [format_float],
+            'PRCP': [format_float],
+            'FRSHTT': [format_frshtt],
+            'DATE': [format_date],
         }
 
     def format_float(self, df: pd.DataFrame, col_name: str) -> pd.Series:
@@ -40,23 +87,111 @@ class ObservationFormatter:
         col = df[col_name]
         return pd.to_datetime(col, errors='coerce').dt.strftime('%Y-%m-%d').where(col.notnull(), pd.NA)
 
+    def format_typed(self, df: pd.DataFrame, col_name: str) -> pd.Series:
+        return df[col_name].round(2).astype(self.TYPED_SCHEMA[col_name])
+
+    def format_frshtt_bitfield(self, df: pd.DataFrame, col_name: str) -> pd.Series:
+        """
+        Packs the six 0/1 flag digits into one integer. Values that are not six binary
+        digits (after zero-padding) become null, so they fail the missing check downstream.
+        """
+        col = df[col_name]
+        if pd.api.types.is_numeric_dtype(col.dtype):
+            values = col.to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            values = pd.to_numeric(col, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+
+        with np.errstate(invalid='ignore'):
+            valid = (values >= 0) & (values < 10 ** self.FRSHTT_FLAG_COUNT) & (values == np.floor(values))
+        digits = np.where(valid, values, 0).astype(np.int64)
+        bits = np.zeros(len(col), dtype=np.uint8)
+        for position in range(self.FRSHTT_FLAG_COUNT):
+            digit = digits % 10
+            valid &= digit <= 1
+            bits |= (digit.astype(np.uint8) << position)
+            digits //= 10
+
+        return pd.Series(
+            pd.arrays.IntegerArray(bits, mask=~valid),
+            index=col.index
+        ).astype(self.TYPED_SCHEMA[col_name])
+
+    def format_arrow(self, df: pd.DataFrame, col_name: str) -> pd.Series:
+        values = np.round(df[col_name].to_numpy(dtype=np.float64, na_value=np.nan), 2)
+        return pd.Series(
+            pd.arrays.ArrowExtensionArray(pa.array(values, from_pandas=True).cast(self.ARROW_SCHEMA[col_name])),
+            index=df.index
+        )
+
+    def format_arrow_frshtt(self, df: pd.DataFrame, col_name: str) -> pd.Series:
+        bits = self.format_frshtt_bitfield(df, col_name)
+        return pd.Series(
+            pd.arrays.ArrowExtensionArray(pa.array(bits, type=self.ARROW_SCHEMA[col_name], from_pandas=True)),
+            index=df.index
+        )
+
+    @staticmethod
+    def to_arrow_column(col: pd.Series) -> pd.Series:
+        """
+        Converts a column to a pyarrow-backed one. Strings repeat on every row, so they are
+        dictionary encoded, as categoricals since pandas can't read dictionary pyarrow dtypes
+        back from parquet. All-null columns (e.g. unused attribute codes) are typed as strings
+        so chunks of the same station share one schema.
+        """
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            return col
+        if isinstance(col.dtype, pd.ArrowDtype):
+            values = pa.array(col.array)
+        else:
+            values = pa.array(col, from_pandas=True)
+
+        if pa.types.is_string(values.type) or pa.types.is_large_string(values.type):
+            return pd.Series(values.dictionary_encode().to_pandas(), index=col.index, name=col.name)
+        if pa.types.is_null(values.type):
+            values = values.cast(pa.string())
+        elif isinstance(col.dtype, pd.ArrowDtype):
+            return col
+        return pd.Series(pd.arrays.ArrowExtensionArray(values), index=col.index)
+
+    def format_typed_date(self, df: pd.DataFrame, col_name: str) -> pd.Series:
+        return pd.to_datetime(df[col_name], errors='coerce').astype(self.TYPED_SCHEMA[col_name])
+
     def replace_value(self, replacements: dict):
         def _replace_value(df: pd.DataFrame, col_name: str) -> pd.Series:
             return df[col_name].replace(replacements)
         return _replace_value
 
-    def format(self) -> pd.DataFrame:
+    def format(self, start_date: pd.Timestamp = None) -> pd.DataFrame:
+        """
+        Formats each column and indexes the observations by date.
+
+        Parameters:
+        - start_date: first date of the expanded index (defaults to the first observed date).
+          Used when formatting a file chunk by chunk so gaps between chunks are filled.
+        """
         for col, formatters in self.formatter_map.items():
             if col in self.df.columns:
                 for formatter in formatters:
                     self.df[col] = formatter(df=self.df, col_name=col)
 
+        if self.arrow:
+            for col in self.df.columns:
+                if col != 'DATE':
+                    self.df[col] = self.to_arrow_column(self.df[col])
+
         self.df = self.df.set_index('DATE')
         self.df.index = pd.to_datetime(self.df.index, errors='coerce')
         self.df = self.df.sort_index(ascending=True)
+
+        first_date = self.df.index.min()
+        if start_date is None:
+            start_date = first_date
+        elif first_date < start_date:
+            raise ValueError(f"Observations start at {first_date}, before the expected start date {start_date}.")
+
         # expand index to include all dates in the range
         self.df = self.df.reindex(
-            pd.date_range(start=self.df.index.min(), end=self.df.index.max()),
+            pd.date_range(start=start_date, end=self.df.index.max()),
         )
 
         return self.df
@@ -1,14 +1,27 @@
 import json
 import logging
 import os
+from urllib.parse import unquote_plus
 
 import awswrangler as wr
 import boto3
+import pandas as pd
+from pyarrow import fs as pa_fs
 
 from utilities import get_bucket_and_key_from_s3_uri
 from observation_validator import ObservationValidator
 from observation_filterer import ObservationFilterer
 from observation_formatter import ObservationFormatter
+from observation_pipeline import merge_row_hash_watermarks, process_new_observation_rows, process_observation_df
+from observation_ingest import DEFAULT_BLOCK_SIZE, stream_process_observation_csv
+from observation_store import (
+    append_station_observations, compact_station_observations, list_observation_appends,
+    merge_partitioned_observations, observation_store_exists, write_partitioned_observations
+)
+from station_registry import (
+    STATION_METADATA_COLUMNS, consolidate_station_registry, get_station_record, get_station_registry,
+    write_station_record
+)
 
 
 logging.basicConfig(level=logging.INFO)
@@ -19,16 +32,54 @@ STATION_IDS_BY_LOCATION_NAME = {
     "oregon1": ["KPDX", "KSLE"]
 }
 
+DEFAULT_COMPACT_EVERY = 30
+STATION_REGISTRY_PREFIX = "station_registry"
+DEFAULT_NEAREST_STATIONS = 5
 
-def generate_observation_s3_uri(prefix, station_id, bucket=None, input_s3_uri=None):
+
+def generate_observation_s3_uri(prefix, station_id, bucket=None, input_s3_uri=None, partitioned=False):
     assert bucket or input_s3_uri, "Either bucket or input_s3_uri must be provided."
 
     if bucket is None:
         bucket, _ = get_bucket_and_key_from_s3_uri(input_s3_uri)
 
+    if partitioned:
+        # Year-partitioned dataset directory, see observation_store.write_partitioned_observations
+        return f"s3://{bucket}/{prefix}/station_id={station_id}"
+
     return f"s3://{bucket}/{prefix}/station_id={station_id}/data.parquet"
 
 
+def get_station_registry_prefix(bucket=None, input_s3_uri=None):
+    if bucket is None:
+        bucket, _ = get_bucket_and_key_from_s3_uri(input_s3_uri)
+    return f"s3://{bucket}/{STATION_REGISTRY_PREFIX}"
+
+
+def record_station_metadata(input_s3_uri, station_id, df=None):
+    """
+    Writes the station's registry record (metadata and observed date range) from its raw file.
+    Only the metadata columns are read when the raw observations aren't already loaded.
+    """
+    if df is None:
+        if input_s3_uri.endswith('.csv'):
+            df = wr.s3.read_csv(input_s3_uri, usecols=STATION_METADATA_COLUMNS)
+        else:
+            df = wr.s3.read_parquet(input_s3_uri, columns=STATION_METADATA_COLUMNS)
+
+    return write_station_record(
+        get_station_record(station_id, df),
+        get_station_registry_prefix(input_s3_uri=input_s3_uri)
+    )
+
+
+def read_raw_observations(input_s3_uri, arrow=False):
+    kwargs = {'dtype_backend': 'pyarrow'} if arrow else {}
+    if input_s3_uri.endswith('.csv'):
+        return wr.s3.read_csv(input_s3_uri, **kwargs)
+    return wr.s3.read_parquet(input_s3_uri, **kwargs)
+
+
 def log_invocation_details(func):
     def wrapper(event, context):
         logger.info(f'Invoked with {event}')
@@ -49,12 +100,12 @@ def observation_validator(event, context):
     df = wr.s3.read_csv(input_s3_uri) if input_s3_uri.endswith('.csv') else wr.s3.read_parquet(input_s3_uri)
 
     validator = ObservationValidator(df)
-    validity_df = validator.validate()
+    validity_df = validator.validate_flags()
 
-    error_rate = validator.calculate_percent_of_rows_with_errors(validity_df)
+    error_rate = validator.calculate_percent_of_rows_with_errors_from_flags(validity_df, column_count=len(df.columns))
     logger.info(f"Total error rate: {error_rate:.2f}%")
 
-    wr.s3.to_parquet(validity_df, path=output_s3_uri)
+    wr.s3.to_parquet(validity_df, path=output_s3_uri, index=True)
 
     return {
         's3_uri': output_s3_uri,
@@ -82,7 +133,7 @@ def observation_filterer(event, context):
     )
     filtered_df = filterer.filter()
 
-    wr.s3.to_parquet(filtered_df, path=output_s3_uri)
+    wr.s3.to_parquet(filtered_df, path=output_s3_uri, index=True)
 
     return output_s3_uri
 
@@ -97,65 +148,319 @@ def observation_formatter(event, context):
         station_id=station_id
     )
 
-    df = wr.s3.read_csv(input_s3_uri) if input_s3_uri.endswith('.csv') else wr.s3.read_parquet(input_s3_uri)
+    arrow = event.get('arrow', False)
+    df = read_raw_observations(input_s3_uri, arrow=arrow)
+    record_station_metadata(input_s3_uri, station_id, df)
 
-    formatter = ObservationFormatter(df)
+    formatter = ObservationFormatter(df, typed=event.get('typed', False), arrow=arrow)
     formatted_df = formatter.format()
 
-    wr.s3.to_parquet(formatted_df, path=output_s3_uri)
+    # The formatter indexes by DATE; the validator and filterer read it back as the index
+    wr.s3.to_parquet(formatted_df, path=output_s3_uri, index=True)
 
     return output_s3_uri
 
 
 @log_invocation_details
-def step_function_invoker(event, context):
-    bucket_name = event['Records'][0]['s3']['bucket']['name']
-    object_key = event['Records'][0]['s3']['object']['key']
-    station_id = object_key.split('/')[-1].split('.')[0]
-
-    # Step Function input
-    step_function_input = {
-        "input_s3_uri": f"s3://{bucket_name}/{object_key}",
-        "station_id": station_id
+def observation_processor(event, context):
+    """
+    Formats, validates, and filters an observation file in one invocation.
+
+    The validity artifact is always written so the error rate can be inspected. Filtered
+    observations are only published when the error rate is within `max_error_rate` (if given),
+    mirroring the error-rate Choice state of the unfused pipeline.
+
+    With `partitioned` set, filtered observations are written as a year-partitioned dataset.
+    With `streaming` set, a raw CSV is read in `block_size` byte chunks with an explicit schema
+    and each chunk is processed and appended to the outputs as it arrives, so peak memory
+    depends on the chunk size rather than the file size. Note that `drop_attributes` removes
+    columns that are never invalid, so the reported error rate is higher than with them kept.
+    With `arrow` set, observations stay pyarrow-backed from the read to the parquet write.
+
+    Args:
+        event (dict): Contains `input_s3_uri`, `station_id`, and optionally `max_error_rate`,
+            `partitioned`, `streaming`, `block_size`, `drop_attributes`, `typed`, and `arrow`.
+
+    Returns:
+        dict: The validity S3 URI, the error rate, and the filtered S3 URI (None if not published).
+    """
+    input_s3_uri = event['input_s3_uri']
+    station_id = event['station_id']
+    max_error_rate = event.get('max_error_rate', None)
+    partitioned = event.get('partitioned', False)
+    arrow = event.get('arrow', False)
+    validation_s3_uri = generate_observation_s3_uri(
+        input_s3_uri=input_s3_uri,
+        prefix="validated",
+        station_id=station_id
+    )
+    filtered_s3_uri = generate_observation_s3_uri(
+        input_s3_uri=input_s3_uri,
+        prefix="filtered",
+        station_id=station_id,
+        partitioned=partitioned
+    )
+
+    if event.get('streaming', False):
+        if partitioned:
+            raise ValueError("Streaming ingest writes a single-file store; it can't be combined with partitioned.")
+        filesystem = pa_fs.S3FileSystem()
+        with filesystem.open_input_stream(input_s3_uri[len('s3://'):]) as source:
+            error_rate = stream_process_observation_csv(
+                source,
+                filtered_path=filtered_s3_uri[len('s3://'):],
+                validation_path=validation_s3_uri[len('s3://'):],
+                filesystem=filesystem,
+                block_size=event.get('block_size', DEFAULT_BLOCK_SIZE),
+                drop_attributes=event.get('drop_attributes', False),
+                typed=event.get('typed', False),
+                arrow=arrow
+            )
+        logger.info(f"Total error rate: {error_rate:.2f}%")
+        record_station_metadata(input_s3_uri, station_id)
+
+        if max_error_rate is not None and error_rate > max_error_rate:
+            logger.info(f"Error rate above {max_error_rate}, removing filtered observations")
+            filesystem.delete_file(filtered_s3_uri[len('s3://'):])
+            filtered_s3_uri = None
+    else:
+        df = read_raw_observations(input_s3_uri, arrow=arrow)
+        record_station_metadata(input_s3_uri, station_id, df)
+
+        filtered_df, validity_df, error_rate = process_observation_df(df, typed=event.get('typed', False), arrow=arrow)
+        logger.info(f"Total error rate: {error_rate:.2f}%")
+
+        wr.s3.to_parquet(validity_df, path=validation_s3_uri)
+
+        if max_error_rate is not None and error_rate > max_error_rate:
+            logger.info(f"Error rate above {max_error_rate}, not writing filtered observations")
+            filtered_s3_uri = None
+        elif partitioned:
+            write_partitioned_observations(filtered_df, filtered_s3_uri)
+        else:
+            wr.s3.to_parquet(filtered_df, path=filtered_s3_uri, index=True)
+
+    return {
+        's3_uri': validation_s3_uri,
+        'error_rate': error_rate,
+        'filtered_s3_uri': filtered_s3_uri
     }
 
-    stepfunctions_client = boto3.client('stepfunctions')
 
-    # Start Step Function execution
-    response = stepfunctions_client.start_execution(
-        stateMachineArn=os.environ['STEP_FUNCTION_ARN'],
-        input=json.dumps(step_function_input)
+@log_invocation_details
+def observation_incremental_processor(event, context):
+    """
+    Processes only the rows of an observation file that are new or changed since the last run.
+
+    A per-station watermark of processed row hashes (and their dates) decides which rows to
+    format, validate, and filter. The first run for a station writes the base filtered file;
+    later runs write the new rows as an appended part, and every `compact_every` parts are
+    folded back into the base file. With `partitioned` set, the new rows are merged straight
+    into the year partitions they touch instead.
+
+    Args:
+        event (dict): Contains `input_s3_uri`, `station_id`, and optionally `max_error_rate`,
+            `compact_every`, `partitioned`, `typed`, and `arrow`.
+
+    Returns:
+        dict: The validity S3 URI, the error rate of the processed rows, the filtered S3 URI
+            (None if not published), and the station's high-water mark date.
+    """
+    input_s3_uri = event['input_s3_uri']
+    station_id = event['station_id']
+    max_error_rate = event.get('max_error_rate', None)
+    compact_every = event.get('compact_every', DEFAULT_COMPACT_EVERY)
+    partitioned = event.get('partitioned', False)
+    validation_s3_uri = generate_observation_s3_uri(
+        input_s3_uri=input_s3_uri,
+        prefix="validated",
+        station_id=station_id
     )
+    filtered_s3_uri = generate_observation_s3_uri(
+        input_s3_uri=input_s3_uri,
+        prefix="filtered",
+        station_id=station_id,
+        partitioned=partitioned
+    )
+    watermark_s3_uri = generate_observation_s3_uri(
+        input_s3_uri=input_s3_uri,
+        prefix="watermarks",
+        station_id=station_id
+    )
+
+    df = wr.s3.read_csv(input_s3_uri) if input_s3_uri.endswith('.csv') else wr.s3.read_parquet(input_s3_uri)
+    record_station_metadata(input_s3_uri, station_id, df)
+
+    watermark_df = None
+    processed_row_hashes = None
+    if wr.s3.does_object_exist(watermark_s3_uri) and observation_store_exists(filtered_s3_uri):
+        watermark_df = wr.s3.read_parquet(watermark_s3_uri)
+        processed_row_hashes = watermark_df['row_hash']
+
+    filtered_df, validity_df, error_rate, row_hashes = process_new_observation_rows(
+        df, processed_row_hashes=processed_row_hashes, typed=event.get('typed', False),
+        arrow=event.get('arrow', False)
+    )
+    dates = pd.to_datetime(df['DATE'], errors='coerce')
+    result = {
+        's3_uri': validation_s3_uri,
+        'error_rate': error_rate,
+        'filtered_s3_uri': filtered_s3_uri,
+        'high_water_mark': str(dates.max().date())
+    }
+
+    if filtered_df is None:
+        logger.info("No new or changed observations")
+        return result
+
+    logger.info(f"Processed {len(filtered_df)} new or changed dates, error rate: {error_rate:.2f}%")
+    wr.s3.to_parquet(validity_df, path=validation_s3_uri)
+
+    if max_error_rate is not None and error_rate > max_error_rate:
+        logger.info(f"Error rate above {max_error_rate}, not writing filtered observations")
+        result['filtered_s3_uri'] = None
+        return result
+
+    if partitioned and processed_row_hashes is None:
+        write_partitioned_observations(filtered_df, filtered_s3_uri)
+    elif partitioned:
+        merge_partitioned_observations(filtered_df, filtered_s3_uri)
+    elif processed_row_hashes is None:
+        # The base file keeps the DATE index, like the appended parts merged onto it
+        wr.s3.to_parquet(filtered_df, path=filtered_s3_uri, index=True)
+    else:
+        append_station_observations(filtered_df, filtered_s3_uri)
+        if len(list_observation_appends(filtered_s3_uri)) >= compact_every:
+            compacted = compact_station_observations(filtered_s3_uri)
+            logger.info(f"Compacted {compacted} appended parts into {filtered_s3_uri}")
+
+    current_watermark_df = pd.DataFrame({'DATE': dates, 'row_hash': row_hashes})
+    if watermark_df is not None:
+        current_watermark_df = merge_row_hash_watermarks(watermark_df, current_watermark_df)
+    wr.s3.to_parquet(current_watermark_df, path=watermark_s3_uri, index=False)
+
+    return result
+
+
+@log_invocation_details
+def step_function_invoker(event, context):
+    """
+    Starts one observation Step Function execution per record of an S3 notification.
+    S3 may batch several uploaded objects into a single event.
+    """
+    stepfunctions_client = boto3.client('stepfunctions')
+
+    execution_arns = []
+    for record in event['Records']:
+        bucket_name = record['s3']['bucket']['name']
+        object_key = unquote_plus(record['s3']['object']['key'])
+        station_id = object_key.split('/')[-1].split('.')[0]
+
+        # Step Function input
+        step_function_input = {
+            "input_s3_uri": f"s3://{bucket_name}/{object_key}",
+            "station_id": station_id
+        }
+
+        # Start Step Function execution
+        response = stepfunctions_client.start_execution(
+            stateMachineArn=os.environ['STEP_FUNCTION_ARN'],
+            input=json.dumps(step_function_input)
+        )
+        execution_arns.append(response['executionArn'])
 
     return {
         "statusCode": 200,
-        "body": json.dumps(response)
+        "body": json.dumps({"execution_arns": execution_arns})
     }
 
 
+@log_invocation_details
+def station_registry_builder(event, context):
+    """
+    Consolidates the per-station records written during ingest into the station registry.
+
+    Args:
+        event (dict): Optionally contains `registry_prefix` (defaults to the station registry
+            in the observation bucket).
+
+    Returns:
+        dict: The registry S3 URI.
+    """
+    registry_prefix = event.get('registry_prefix') or get_station_registry_prefix(bucket=os.environ["OBSERVATION_BUCKET"])
+
+    return {'registry_s3_uri': consolidate_station_registry(registry_prefix)}
+
+
+def find_nearest_station_ids(registry, locations, k, radius_km, start_date, end_date):
+    """
+    Station IDs nearest to each location (dicts with `latitude` and `longitude`), nearest first.
+    """
+    matches = registry.nearest_stations_batch(
+        [location['latitude'] for location in locations],
+        [location['longitude'] for location in locations],
+        k=k, radius_km=radius_km, start_date=start_date, end_date=end_date
+    )
+    station_ids_by_location = [[] for _ in locations]
+    for location, station_id in zip(matches['location'], matches['station_id']):
+        station_ids_by_location[location].append(station_id)
+
+    return station_ids_by_location
+
+
 @log_invocation_details
 def relevant_observation_s3_uri_by_station_assembler(event, context):
     """
     Assembles a dictionary of S3 URIs for observations by station ID.
 
+    Stations come from the station registry when the event has coordinates: the `k` nearest
+    stations within `radius_km` whose observations span `start_date` to `end_date` (each
+    optional). With `locations` (a list of dicts with `location_name`, `latitude`, and
+    `longitude`) every location is looked up in one batch. Otherwise the stations are those
+    configured for `location_name` in STATION_IDS_BY_LOCATION_NAME.
+
     Args:
-        event (dict): The event containing the S3 URIs and station IDs.
+        event (dict): The event containing the location(s) and lookup options.
 
     Returns:
-        dict: A dictionary mapping station IDs to their corresponding S3 URIs.
+        dict: A dictionary mapping station IDs to their corresponding S3 URIs, or for
+            `locations`, one such dictionary by location name.
     """
-    location_name = event['location_name']
-    station_ids = STATION_IDS_BY_LOCATION_NAME.get(location_name, [])
-
-    observation_s3_uri_by_station_id = {
-        station_id: generate_observation_s3_uri(
-            bucket=os.environ["OBSERVATION_BUCKET"],
-            prefix="observations",
-            station_id=station_id
-        )
-        for station_id in station_ids
-    }
-
-    return observation_s3_uri_by_station_id
+    bucket = os.environ["OBSERVATION_BUCKET"]
+    partitioned = os.environ.get("PARTITIONED_OBSERVATIONS", "false") == "true"
+
+    def get_observation_s3_uri_by_station_id(station_ids):
+        return {
+            station_id: generate_observation_s3_uri(
+                bucket=bucket,
+                prefix="observations",
+                station_id=station_id,
+                partitioned=partitioned
+            )
+            for station_id in station_ids
+        }
+
+    locations = event.get('locations')
+    if locations is None and 'latitude' in event:
+        locations = [event]
+
+    if locations is None:
+        return get_observation_s3_uri_by_station_id(STATION_IDS_BY_LOCATION_NAME.get(event['location_name'], []))
+
+    registry = get_station_registry(get_station_registry_prefix(bucket=bucket))
+    station_ids_by_location = find_nearest_station_ids(
+        registry,
+        locations,
+        k=event.get('k', DEFAULT_NEAREST_STATIONS),
+        radius_km=event.get('radius_km'),
+        start_date=event.get('start_date'),
+        end_date=event.get('end_date')
+    )
 
+    if 'locations' not in event:
+        return get_observation_s3_uri_by_station_id(station_ids_by_location[0])
 
+    return {
+        location['location_name']: get_observation_s3_uri_by_station_id(station_ids)
+        for location, station_ids in zip(locations, station_ids_by_location)
+    }
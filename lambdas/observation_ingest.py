@@ -0,0 +1,115 @@
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from observation_pipeline import process_observation_chunks
+from observation_store import arrow_types_mapper
+
+
+DICTIONARY_STRING = pa.dictionary(pa.int32(), pa.string())
+
+MEASUREMENT_COLUMNS = [
+    'DEWP', 'GUST', 'MAX', 'MIN', 'MXSPD', 'PRCP', 'SLP', 'SNDP', 'STP', 'TEMP', 'VISIB', 'WDSP'
+]
+
+# Explicit schema for raw GSOD daily summary files, so nothing is inferred per chunk.
+# Station metadata and the per-measurement attribute codes repeat on every row, so they are
+# dictionary encoded and arrive in pandas as categoricals rather than Python strings.
+RAW_OBSERVATION_SCHEMA = {
+    'STATION': DICTIONARY_STRING,
+    'NAME': DICTIONARY_STRING,
+    'LATITUDE': pa.float64(),
+    'LONGITUDE': pa.float64(),
+    'ELEVATION': pa.float64(),
+    'DATE': pa.timestamp('s'),
+    'FRSHTT': pa.int64(),
+    'FRSHTT_ATTRIBUTES': DICTIONARY_STRING,
+    **{col: pa.float64() for col in MEASUREMENT_COLUMNS},
+    **{f'{col}_ATTRIBUTES': DICTIONARY_STRING for col in MEASUREMENT_COLUMNS},
+}
+
+ATTRIBUTE_SUFFIX = '_ATTRIBUTES'
+DEFAULT_BLOCK_SIZE = 16 << 20
+
+
+def read_observation_csv_chunks(source, block_size: int = DEFAULT_BLOCK_SIZE, drop_attributes: bool = False,
+                                arrow: bool = False) -> Iterator[pd.DataFrame]:
+    """
+    Streams a raw GSOD station CSV as DataFrame chunks using the pyarrow CSV reader.
+
+    Parameters:
+    - source: local path or readable file-like object (e.g. a pyarrow S3 input stream).
+    - block_size: bytes of CSV parsed per chunk; bounds peak memory.
+    - drop_attributes: drop the `*_ATTRIBUTES` columns before they are converted to pandas.
+    - arrow: keep the Arrow columns as pyarrow-backed pandas columns instead of converting them.
+    """
+    reader = pa_csv.open_csv(
+        source,
+        read_options=pa_csv.ReadOptions(block_size=block_size),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=RAW_OBSERVATION_SCHEMA,
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=True
+        )
+    )
+    columns = [
+        c for c in reader.schema.names
+        if not (drop_attributes and c.endswith(ATTRIBUTE_SUFFIX))
+    ]
+
+    for batch in reader:
+        yield pa.Table.from_batches([batch]).select(columns).to_pandas(types_mapper=arrow_types_mapper if arrow else None)
+
+
+def stream_process_observation_csv(source, filtered_path: str, validation_path: str, filesystem=None,
+                                   block_size: int = DEFAULT_BLOCK_SIZE, drop_attributes: bool = False,
+                                   typed: bool = False, arrow: bool = False) -> float:
+    """
+    Formats, validates, and filters a raw station CSV chunk by chunk, appending each chunk's
+    results to the filtered and validity flags parquet files as a new row group.
+
+    Parameters:
+    - source: local path or readable file-like object for the raw CSV.
+    - filtered_path: destination of the filtered observations parquet file.
+    - validation_path: destination of the validity flags parquet file.
+    - filesystem: optional pyarrow filesystem for the destinations (e.g. pyarrow.fs.S3FileSystem()).
+    - block_size: bytes of CSV parsed per chunk.
+    - drop_attributes: drop the `*_ATTRIBUTES` columns.
+    - typed: format to ObservationFormatter.TYPED_SCHEMA dtypes.
+    - arrow: process pyarrow-backed chunks end to end (see ObservationFormatter.ARROW_SCHEMA).
+
+    Returns:
+    - The percent of cells with errors across the whole file.
+    """
+    filtered_writer, validation_writer = None, None
+    invalid_cells, total_cells = 0, 0
+    try:
+        chunks = read_observation_csv_chunks(source, block_size=block_size, drop_attributes=drop_attributes, arrow=arrow)
+        for filtered_df, validity_df in process_observation_chunks(chunks, typed=typed, arrow=arrow):
+            invalid_cells += np.count_nonzero(validity_df.to_numpy())
+            total_cells += filtered_df.size
+
+            if filtered_writer is None:
+                filtered_table = pa.Table.from_pandas(filtered_df)
+                validity_table = pa.Table.from_pandas(validity_df)
+                filtered_writer = pq.ParquetWriter(filtered_path, filtered_table.schema, filesystem=filesystem)
+                validation_writer = pq.ParquetWriter(validation_path, validity_table.schema, filesystem=filesystem)
+            else:
+                filtered_table = pa.Table.from_pandas(filtered_df, schema=filtered_writer.schema)
+                validity_table = pa.Table.from_pandas(validity_df, schema=validation_writer.schema)
+
+            filtered_writer.write_table(filtered_table)
+            validation_writer.write_table(validity_table)
+    finally:
+        for writer in (filtered_writer, validation_writer):
+            if writer is not None:
+                writer.close()
+
+    if total_cells == 0:
+        raise ValueError("No observations found in source.")
+
+    return 100 * invalid_cells / total_cells
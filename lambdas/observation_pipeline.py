@@ -0,0 +1,131 @@
+from typing import Iterable, Iterator, Tuple
+
+import pandas as pd
+
+from observation_filterer import ObservationFilterer
+from observation_formatter import ObservationFormatter
+from observation_validator import ObservationValidator
+
+
+def process_observation_df(df: pd.DataFrame, typed: bool = False,
+                           arrow: bool = False) -> Tuple[pd.DataFrame, pd.DataFrame, float]:
+    """
+    Formats, validates, and filters a station's raw observations on a single in-memory frame.
+
+    Args:
+        df (pd.DataFrame): Raw observations as read from a station file.
+        typed (bool): Format to ObservationFormatter.TYPED_SCHEMA dtypes.
+        arrow (bool): Format to pyarrow-backed columns (ObservationFormatter.ARROW_SCHEMA).
+
+    Returns:
+        tuple: The filtered observations, the validity bitmask flags (see
+            ObservationValidator.validate_flags), and the percent of cells with errors.
+    """
+    formatted_df = ObservationFormatter(df, typed=typed, arrow=arrow).format()
+
+    validator = ObservationValidator(formatted_df)
+    validity_flags_df = validator.validate_flags()
+    error_rate = validator.calculate_percent_of_rows_with_errors_from_flags(
+        validity_flags_df, column_count=len(formatted_df.columns)
+    )
+
+    filterer = ObservationFilterer(df=formatted_df, validation_df=validity_flags_df)
+    filtered_df = filterer.filter()
+
+    return filtered_df, validity_flags_df, error_rate
+
+
+def process_observation_chunks(chunks: Iterable[pd.DataFrame], typed: bool = False,
+                               arrow: bool = False) -> Iterator[Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    Formats, validates, and filters raw observations one chunk at a time.
+
+    Chunks must arrive in ascending date order, as GSOD station files do. Each chunk's date
+    index continues from the day after the previous chunk so gaps spanning a chunk boundary
+    are filled exactly as they are when the whole file is formatted at once.
+
+    Args:
+        chunks (Iterable[pd.DataFrame]): Raw observation chunks, owned by this function.
+        typed (bool): Format to ObservationFormatter.TYPED_SCHEMA dtypes.
+        arrow (bool): Format to pyarrow-backed columns (ObservationFormatter.ARROW_SCHEMA).
+
+    Yields:
+        tuple: The filtered observations and the validity bitmask flags for each chunk.
+    """
+    start_date = None
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+
+        formatted_df = ObservationFormatter(chunk, copy=False, typed=typed, arrow=arrow).format(start_date=start_date)
+        start_date = formatted_df.index.max() + pd.Timedelta(days=1)
+
+        validity_flags_df = ObservationValidator(formatted_df).validate_flags()
+        filtered_df = ObservationFilterer(df=formatted_df, validation_df=validity_flags_df).filter()
+
+        yield filtered_df, validity_flags_df
+
+
+def hash_observation_rows(df: pd.DataFrame) -> pd.Series:
+    """
+    Hashes each raw observation row (DATE included) so new or changed rows can be detected.
+    """
+    return pd.util.hash_pandas_object(df, index=False)
+
+
+def process_new_observation_rows(df: pd.DataFrame, processed_row_hashes: pd.Series = None, typed: bool = False,
+                                 arrow: bool = False) -> Tuple[pd.DataFrame, pd.DataFrame, float, pd.Series]:
+    """
+    Formats, validates, and filters only the raw rows that were not processed before.
+
+    Args:
+        df (pd.DataFrame): Raw observations as read from a station file.
+        processed_row_hashes (pd.Series): Row hashes from the previous run (None processes every row).
+        typed (bool): Format to ObservationFormatter.TYPED_SCHEMA dtypes.
+        arrow (bool): Format to pyarrow-backed columns (ObservationFormatter.ARROW_SCHEMA).
+
+    Returns:
+        tuple: The filtered observations and validity flags restricted to the new or changed dates (None
+            if nothing changed), their percent of cells with errors, and the hashes of all rows.
+    """
+    row_hashes = hash_observation_rows(df)
+    if processed_row_hashes is not None:
+        df = df.loc[~row_hashes.isin(processed_row_hashes).to_numpy()]
+
+    if df.empty:
+        return None, None, 0.0, row_hashes
+
+    filtered_df, validity_flags_df, _ = process_observation_df(df, typed=typed, arrow=arrow)
+
+    if processed_row_hashes is not None:
+        # Changed rows may be scattered through history; don't let the date-range fill between
+        # them overwrite rows that were already processed.
+        new_dates = filtered_df.index.isin(pd.to_datetime(df['DATE'], errors='coerce'))
+        filtered_df, validity_flags_df = filtered_df.loc[new_dates], validity_flags_df.loc[new_dates]
+
+    error_rate = ObservationValidator.calculate_percent_of_rows_with_errors_from_flags(
+        validity_flags_df, column_count=len(filtered_df.columns)
+    )
+
+    return filtered_df, validity_flags_df, error_rate, row_hashes
+
+
+def merge_row_hash_watermarks(processed_df: pd.DataFrame, current_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds the row hashes of the current input to those processed before, so an input holding
+    only some dates (e.g. a top-up of new days) doesn't drop the history from the watermark.
+
+    Args:
+        processed_df (pd.DataFrame): The stored watermark, with `DATE` and `row_hash` columns.
+        current_df (pd.DataFrame): The current input's dates and row hashes.
+
+    Returns:
+        pd.DataFrame: One row per date with its latest hash, plus the hashes of undated rows.
+    """
+    watermark_df = pd.concat([processed_df[['DATE', 'row_hash']], current_df], ignore_index=True)
+    dated = watermark_df['DATE'].notna()
+
+    return pd.concat([
+        watermark_df.loc[dated].drop_duplicates('DATE', keep='last'),
+        watermark_df.loc[~dated].drop_duplicates('row_hash', keep='last')
+    ]).sort_values('DATE', ignore_index=True)
@@ -0,0 +1,255 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from typing import List, Tuple
+
+import awswrangler as wr
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from pyarrow import fs as pa_fs
+
+
+APPENDS_PREFIX = 'appends'
+DATE_COLUMN = 'DATE'
+PARTITION_COLUMN = 'year'
+OBSERVATION_PARTITIONING = ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.int32())]), flavor='hive')
+# Row groups of roughly a quarter each, so date filters can also skip data within a year partition
+ROWS_PER_GROUP = 92
+
+
+def is_partitioned_store(uri: str) -> bool:
+    """
+    Single-file stores are addressed by their `.../data.parquet` file; partitioned stores by their directory.
+    """
+    return not uri.endswith('.parquet')
+
+
+def resolve_filesystem(uri: str) -> Tuple[pa_fs.FileSystem, str]:
+    if uri.startswith('s3://'):
+        return pa_fs.FileSystem.from_uri(uri)
+    return pa_fs.LocalFileSystem(), os.path.abspath(uri)
+
+
+def arrow_types_mapper(arrow_type: pa.DataType):
+    """
+    types_mapper for Table.to_pandas that keeps Arrow columns pyarrow-backed. Dictionary strings
+    become categoricals instead, since pandas can't read dictionary pyarrow dtypes back from parquet.
+    """
+    return None if pa.types.is_dictionary(arrow_type) else pd.ArrowDtype(arrow_type)
+
+
+def read_observations(uri: str, start_date=None, end_date=None, columns: List[str] = None,
+                      arrow: bool = False) -> pd.DataFrame:
+    """
+    Reads observations from a single parquet file or a year-partitioned dataset, pushing the
+    date range and column selection down into the read. Year partitions outside the range are
+    never opened, and row-group statistics skip the rest.
+
+    Parameters:
+    - uri: local path or S3 URI of the file or dataset directory.
+    - start_date, end_date: inclusive date range to read (open-ended when None).
+    - columns: observation columns to read (all columns when None).
+    - arrow: return pyarrow-backed columns instead of converting them to NumPy.
+
+    Returns:
+    - Observations indexed by every date between the first and last date read.
+    """
+    df = read_observation_rows(uri, start_date=start_date, end_date=end_date, columns=columns, arrow=arrow)
+    if df.empty:
+        return df
+
+    return df.reindex(pd.date_range(start=df.index.min(), end=df.index.max()))
+
+
+def read_observation_rows(uri: str, start_date=None, end_date=None, columns: List[str] = None,
+                          arrow: bool = False) -> pd.DataFrame:
+    """
+    Reads the stored observation rows like read_observations, without expanding the index to
+    every date, so dates missing from the file don't become rows.
+    """
+    filesystem, path = resolve_filesystem(uri)
+    is_partitioned = is_partitioned_store(uri)
+    partitioning = OBSERVATION_PARTITIONING if is_partitioned else None
+    dataset = ds.dataset(path, filesystem=filesystem, format='parquet', partitioning=partitioning)
+
+    pandas_metadata = dataset.schema.pandas_metadata or {}
+    index_columns = [c for c in pandas_metadata.get('index_columns', []) if isinstance(c, str)]
+    if DATE_COLUMN in dataset.schema.names:
+        date_column = DATE_COLUMN
+    elif index_columns:
+        date_column = index_columns[0]
+    else:
+        raise ValueError(f"{uri} has neither a {DATE_COLUMN} column nor a stored index to read dates from.")
+    date_type = dataset.schema.field(date_column).type
+
+    expression = ds.scalar(True)
+    if start_date is not None:
+        start_date = pd.Timestamp(start_date)
+        expression &= ds.field(date_column) >= pa.scalar(start_date, type=date_type)
+        if is_partitioned:
+            expression &= ds.field(PARTITION_COLUMN) >= start_date.year
+    if end_date is not None:
+        end_date = pd.Timestamp(end_date)
+        expression &= ds.field(date_column) <= pa.scalar(end_date, type=date_type)
+        if is_partitioned:
+            expression &= ds.field(PARTITION_COLUMN) <= end_date.year
+
+    if columns is not None:
+        columns = [date_column] + [c for c in columns if c in dataset.schema.names and c != date_column]
+
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas(types_mapper=arrow_types_mapper if arrow else None)
+    if date_column in df.columns:
+        df = df.set_index(date_column)
+    if arrow:
+        df.index = pd.DatetimeIndex(df.index.to_numpy(dtype='datetime64[ns]'))
+    df = df.drop(columns=[PARTITION_COLUMN], errors='ignore').sort_index(ascending=True)
+    df.index.name = None
+
+    return df
+
+
+def write_partitioned_observations(df: pd.DataFrame, uri: str, overwrite: bool = True):
+    """
+    Writes observations as a year-partitioned dataset (`{uri}/year=YYYY/part-0.parquet`).
+
+    Parameters:
+    - df: observations indexed by date.
+    - uri: local path or S3 URI of the dataset directory.
+    - overwrite: replace the whole dataset; otherwise only the years present in `df` are replaced.
+    """
+    filesystem, path = resolve_filesystem(uri)
+    if overwrite:
+        filesystem.delete_dir_contents(path, missing_dir_ok=True)
+
+    df = df.rename_axis(DATE_COLUMN).reset_index()
+    df[PARTITION_COLUMN] = df[DATE_COLUMN].dt.year.astype('int32')
+
+    ds.write_dataset(
+        pa.Table.from_pandas(df, preserve_index=False),
+        path,
+        filesystem=filesystem,
+        format='parquet',
+        partitioning=OBSERVATION_PARTITIONING,
+        basename_template='part-{i}.parquet',
+        existing_data_behavior='delete_matching',
+        file_options=ds.ParquetFileFormat().make_write_options(write_statistics=True),
+        min_rows_per_group=ROWS_PER_GROUP,
+        max_rows_per_group=ROWS_PER_GROUP
+    )
+
+
+def merge_partitioned_observations(df: pd.DataFrame, uri: str):
+    """
+    Merges newly processed observations into a year-partitioned dataset, rewriting only the
+    years they touch.
+    """
+    start_date = pd.Timestamp(year=df.index.min().year, month=1, day=1)
+    end_date = pd.Timestamp(year=df.index.max().year, month=12, day=31)
+    existing_df = read_observations(uri, start_date=start_date, end_date=end_date)
+
+    parts = [existing_df, df] if not existing_df.empty else [df]
+    write_partitioned_observations(merge_observation_parts(parts), uri, overwrite=False)
+
+
+def observation_store_exists(uri: str) -> bool:
+    if is_partitioned_store(uri):
+        filesystem, path = resolve_filesystem(uri)
+        return filesystem.get_file_info(path).type == pa_fs.FileType.Directory
+    return wr.s3.does_object_exist(uri)
+
+
+def get_appends_prefix(data_s3_uri: str) -> str:
+    """
+    Appended observation parts live next to a station's base file:
+    `.../station_id=X/data.parquet` -> `.../station_id=X/appends/`.
+    """
+    return f"{data_s3_uri.rsplit('/', 1)[0]}/{APPENDS_PREFIX}/"
+
+
+def merge_observation_parts(parts: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Merges a base observation frame with later appended parts. A date present in several
+    parts keeps the row from the latest part, and the index is expanded to every date.
+    """
+    df = pd.concat(parts)
+    df = df.loc[~df.index.duplicated(keep='last')].sort_index(ascending=True)
+
+    return df.reindex(pd.date_range(start=df.index.min(), end=df.index.max()))
+
+
+def list_observation_appends(data_s3_uri: str) -> List[str]:
+    return sorted(wr.s3.list_objects(get_appends_prefix(data_s3_uri), suffix='.parquet'))
+
+
+def read_station_observations(uri: str, start_date=None, end_date=None, columns: List[str] = None,
+                              arrow: bool = False) -> pd.DataFrame:
+    """
+    Reads a station's filtered observations, pushing the date range and columns into the read.
+    For single-file S3 stores this includes any parts appended since the last compaction.
+    """
+    df = read_observations(uri, start_date=start_date, end_date=end_date, columns=columns, arrow=arrow)
+
+    if is_partitioned_store(uri) or not uri.startswith('s3://'):
+        return df
+
+    append_s3_uris = list_observation_appends(uri)
+    if append_s3_uris:
+        # Appended parts are read like the base file, so the result's dtypes don't depend on history
+        appends = [
+            read_observation_rows(append_uri, start_date=start_date, end_date=end_date, columns=columns, arrow=arrow)
+            for append_uri in append_s3_uris
+        ]
+        df = merge_observation_parts([df] + appends)
+
+    return df
+
+
+def get_station_observations_version(uri: str) -> str:
+    """
+    Version of a station's stored observations, derived from file metadata only: the path,
+    size and modification time of every file read_station_observations would read. It changes
+    whenever the store is rewritten, merged, appended to, or compacted.
+    """
+    filesystem, path = resolve_filesystem(uri)
+    if is_partitioned_store(uri):
+        infos = filesystem.get_file_info(pa_fs.FileSelector(path, recursive=True, allow_not_found=True))
+    else:
+        infos = [filesystem.get_file_info(path)]
+        if uri.startswith('s3://'):
+            appends_filesystem, appends_path = resolve_filesystem(get_appends_prefix(uri))
+            infos += appends_filesystem.get_file_info(pa_fs.FileSelector(appends_path, allow_not_found=True))
+
+    files = sorted((info.path, info.size, info.mtime_ns) for info in infos if info.type == pa_fs.FileType.File)
+    return hashlib.sha256(json.dumps(files).encode()).hexdigest()
+
+
+def append_station_observations(df: pd.DataFrame, data_s3_uri: str) -> str:
+    """
+    Writes newly processed observations as a new part next to the station's base file.
+    """
+    timestamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+    append_s3_uri = f"{get_appends_prefix(data_s3_uri)}{timestamp}.parquet"
+    # Observations are indexed by DATE, which merge_observation_parts dedups and expands on
+    wr.s3.to_parquet(df, path=append_s3_uri, index=True)
+
+    return append_s3_uri
+
+
+def compact_station_observations(data_s3_uri: str) -> int:
+    """
+    Folds appended parts into the station's base file and removes them.
+
+    Returns:
+    - The number of parts compacted.
+    """
+    append_s3_uris = list_observation_appends(data_s3_uri)
+    if not append_s3_uris:
+        return 0
+
+    parts = [wr.s3.read_parquet(data_s3_uri)] + [wr.s3.read_parquet(uri) for uri in append_s3_uris]
+    wr.s3.to_parquet(merge_observation_parts(parts), path=data_s3_uri, index=True)
+    wr.s3.delete_objects(append_s3_uris)
+
+    return len(append_s3_uris)
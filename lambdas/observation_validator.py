@@ -1,5 +1,10 @@
+from contextlib import contextmanager
 from functools import wraps
+import json
 import logging
+import time
+
+import numpy as np
 import pandas as pd
 
 logging.basicConfig(level=logging.INFO)
@@ -10,25 +15,90 @@ def log_validation(func):
     @wraps(func)
     def wrapper(df: pd.DataFrame, col_name: str):
         result = func(df, col_name)
-        invalid_pct = 100 * (~result).mean()
-        message = f"{func.__name__}: {col_name} → {invalid_pct:.2f}% invalid"
-        logger.info(message)
-        print(message)
+        # Per-check results are collected by ValidationMetrics; only pay for this line when debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            invalid_pct = 100 * (~result).mean()
+            logger.debug(f"{func.__name__}: {col_name} → {invalid_pct:.2f}% invalid")
         return result
     return wrapper
 
 
+class ValidationMetrics:
+    """
+    Collects per-column, per-check invalid counts during validation and emits them as a single
+    structured JSON log line. Rows and counts add up across passes, so validating a file in
+    chunks reports one entry per check over all of its rows. Check timings are only collected
+    when `detailed` is set, so the collector costs next to nothing otherwise.
+    """
+    def __init__(self, detailed: bool = False):
+        self.detailed = detailed
+        self.row_count = 0
+        # Invalid counts by (column, check), in the order checks were first recorded
+        self.invalid_counts = {}
+        self.timings_ms = {}
+
+    @contextmanager
+    def timer(self, name: str):
+        if not self.detailed:
+            yield
+            return
+        start = time.perf_counter()
+        yield
+        self.timings_ms[name] = self.timings_ms.get(name, 0.0) + 1000 * (time.perf_counter() - start)
+
+    def record_flags(self, flags_df: pd.DataFrame, validation_map: dict):
+        """
+        Records invalid counts for every check from validate_flags output, with one batched
+        count per flag bit.
+        """
+        self.row_count += len(flags_df)
+        flags = flags_df.to_numpy()
+        bit_counts = [np.count_nonzero(flags & (1 << bit), axis=0) for bit in range(flags.dtype.itemsize * 8)]
+        for i, col in enumerate(flags_df.columns):
+            for bit, check in enumerate(validation_map[col]):
+                self.record(col, check.__name__, int(bit_counts[bit][i]))
+
+    def record(self, col_name: str, check_name: str, invalid_count: int):
+        key = (col_name, check_name)
+        self.invalid_counts[key] = self.invalid_counts.get(key, 0) + invalid_count
+
+    def summary(self) -> dict:
+        summary = {
+            'metric': 'observation_validation',
+            'rows': self.row_count,
+            'checks': [
+                {
+                    'column': col_name,
+                    'check': check_name,
+                    'invalid_count': invalid_count,
+                    'invalid_rate': invalid_count / self.row_count if self.row_count else 0.0
+                }
+                for (col_name, check_name), invalid_count in self.invalid_counts.items()
+            ],
+        }
+        if self.detailed:
+            summary['timings_ms'] = {name: round(ms, 3) for name, ms in self.timings_ms.items()}
+        return summary
+
+    def emit(self):
+        logger.info(json.dumps(self.summary()))
+
+
 @log_validation
 def check_missing(df: pd.DataFrame, col_name: str) -> pd.Series:
     return ~df.loc[:, col_name].isnull()
 
 
+check_missing.rule = ('missing',)
+
+
 def check_extreme_values(min_val: float, max_val: float):
     @log_validation
     @wraps(check_extreme_values)
     def _check(df: pd.DataFrame, col_name: str) -> pd.Series:
         series = df.loc[:, col_name]
         return series.between(min_val, max_val) | series.isnull()
+    _check.rule = ('range', min_val, max_val)
     return _check
 
 
@@ -38,6 +108,7 @@ def check_valid_binary_digits(length: int):
     def _check(df: pd.DataFrame, col_name: str) -> pd.Series:
         series = df.loc[:, col_name]
         return series.astype(str).str.fullmatch(f'[01]{{{length}}}') | series.isnull()
+    _check.rule = ('binary_digits', length)
     return _check
 
 
@@ -47,7 +118,7 @@ def check_greater_than(other_col: str):
     is greater than the value in the specified other column.
     """
     @log_validation
-    @wraps(check_valid_binary_digits)
+    @wraps(check_greater_than)
     def _check(df: pd.DataFrame, col_name: str) -> pd.Series:
         series = df.loc[:, col_name]
         if other_col not in df.columns:
@@ -55,12 +126,162 @@ def check_greater_than(other_col: str):
         else:
             other_series = df.loc[:, other_col]
         return (series > other_series) | series.isnull() | other_series.isnull()
+    _check.rule = ('greater_than', other_col)
     return _check
 
 
+class CompiledValidationEngine:
+    """
+    Compiles a validation map into one batched NumPy pass.
+
+    Range, missing and greater-than checks on numeric columns are evaluated together on a
+    single float matrix. Binary-digit checks compare the flag's digits as integers instead of
+    running a regex per row. Checks without a compiled rule fall back to their pandas callable.
+    """
+    def __init__(self, validation_map: dict):
+        self.validation_map = validation_map
+
+    def validate(self, df: pd.DataFrame, metrics: ValidationMetrics = None) -> pd.DataFrame:
+        flags_df = self.validate_flags(df, metrics=metrics)
+
+        validity = np.ones((len(df), len(df.columns)), dtype=bool)
+        column_positions = [df.columns.get_loc(c) for c in flags_df.columns]
+        validity[:, column_positions] = flags_df.to_numpy() == 0
+
+        return pd.DataFrame(validity, index=df.index, columns=df.columns)
+
+    def validate_flags(self, df: pd.DataFrame, metrics: ValidationMetrics = None) -> pd.DataFrame:
+        """
+        Returns one unsigned integer column per validated column of `df`. Bit k of a value is
+        set when the k-th check of that column in the validation map failed for the row, so a
+        value of 0 means the cell is valid. Per-check counts are recorded in `metrics`.
+        """
+        metrics = metrics or ValidationMetrics()
+        columns = [c for c in self.validation_map if c in df.columns]
+        max_checks = max((len(self.validation_map[c]) for c in columns), default=1)
+        flag_dtype = np.uint8 if max_checks <= 8 else np.uint16 if max_checks <= 16 else np.uint32
+        # Stored column-major (one row per validated column) so per-column updates are contiguous
+        flags = np.zeros((len(columns), len(df)), dtype=flag_dtype)
+
+        numeric_columns = [
+            c for c in columns
+            if not any(getattr(check, 'rule', (None,))[0] == 'binary_digits' for check in self.validation_map[c])
+        ]
+        with metrics.timer('numeric'):
+            self._flag_numeric(df, numeric_columns, flags, columns)
+
+        for i, col in enumerate(columns):
+            for bit, check in enumerate(self.validation_map[col]):
+                rule = getattr(check, 'rule', None)
+                if rule is not None and rule[0] != 'binary_digits' and not (rule[0] == 'missing' and col not in numeric_columns):
+                    continue
+                with metrics.timer(rule[0] if rule else check.__name__):
+                    if rule is None:
+                        failed = ~check(df=df, col_name=col).to_numpy(dtype=bool)
+                    elif rule[0] == 'binary_digits':
+                        failed = ~self._check_binary_digits(df[col], length=rule[1])
+                    else:
+                        failed = df[col].isnull().to_numpy()
+                    flags[i] |= failed.astype(flag_dtype) << flag_dtype(bit)
+
+        flags_df = pd.DataFrame(flags.T, index=df.index, columns=columns)
+        metrics.record_flags(flags_df, self.validation_map)
+
+        return flags_df
+
+    def _flag_numeric(self, df: pd.DataFrame, columns: list, flags: np.ndarray, flag_columns: list):
+        if not columns:
+            return
+
+        other_columns = []
+        for col in columns:
+            for check in self.validation_map[col]:
+                rule = getattr(check, 'rule', None)
+                if rule and rule[0] == 'greater_than':
+                    if rule[1] not in df.columns:
+                        raise ValueError(f"Column '{rule[1]}' does not exist in the DataFrame.")
+                    if rule[1] not in columns and rule[1] not in other_columns:
+                        other_columns.append(rule[1])
+
+        matrix_columns = columns + other_columns
+        matrix_positions = {c: i for i, c in enumerate(matrix_columns)}
+        values = df[matrix_columns].to_numpy(dtype=np.float64, na_value=np.nan).T
+        is_null = np.isnan(values)
+
+        # One row of `failed` per compiled check, evaluated in a batch per check kind
+        checks = {'range': [], 'missing': [], 'greater_than': []}
+        check_columns, check_bits = [], []
+        for col in columns:
+            for bit, check in enumerate(self.validation_map[col]):
+                rule = getattr(check, 'rule', None)
+                if rule is None or rule[0] not in checks:
+                    continue
+                checks[rule[0]].append((len(check_columns), matrix_positions[col], rule))
+                check_columns.append(flag_columns.index(col))
+                check_bits.append(bit)
+
+        if not check_columns:
+            return
+
+        failed = np.zeros((len(check_columns), len(df)), dtype=bool)
+        with np.errstate(invalid='ignore'):
+            if checks['range']:
+                slots, j, rules = zip(*checks['range'])
+                j = list(j)
+                lower = np.array([[rule[1]] for rule in rules], dtype=np.float64)
+                upper = np.array([[rule[2]] for rule in rules], dtype=np.float64)
+                failed[list(slots)] = ~is_null[j] & ((values[j] < lower) | (values[j] > upper))
+            if checks['missing']:
+                slots, j, _ = zip(*checks['missing'])
+                failed[list(slots)] = is_null[list(j)]
+            if checks['greater_than']:
+                slots, j, rules = zip(*checks['greater_than'])
+                j, k = list(j), [matrix_positions[rule[1]] for rule in rules]
+                failed[list(slots)] = ~((values[j] > values[k]) | is_null[j] | is_null[k])
+
+        for row, (i, bit) in enumerate(zip(check_columns, check_bits)):
+            flags[i] |= failed[row].astype(flags.dtype) << flags.dtype.type(bit)
+
+    @staticmethod
+    def _check_binary_digits(series: pd.Series, length: int) -> np.ndarray:
+        """
+        Checks that every non-null value has exactly `length` digits, each 0 or 1.
+        Unsigned integer columns are packed bitfields (see ObservationFormatter.TYPED_SCHEMA).
+        Every other column gets the legacy check on its string form (check_valid_binary_digits):
+        signed integers need all `length` digits, so 10000 is not '010000', and floats (e.g.
+        '100000.0') never match.
+        """
+        is_null = series.isnull().to_numpy()
+        if pd.api.types.is_unsigned_integer_dtype(series.dtype):
+            values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+            with np.errstate(invalid='ignore'):
+                valid = values < 2 ** length
+        elif pd.api.types.is_integer_dtype(series.dtype):
+            values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+            with np.errstate(invalid='ignore'):
+                valid = (values >= 10 ** (length - 1)) & (values < 10 ** length)
+            digits = np.where(valid, values, 0).astype(np.int64)
+            for _ in range(length):
+                valid &= digits % 10 <= 1
+                digits //= 10
+        else:
+            codes = np.asarray(series.to_numpy(dtype=object), dtype=f'U{length + 1}').view(np.uint32)
+            codes = codes.reshape(len(series), length + 1)
+            valid = (codes[:, length] == 0) & ((codes[:, :length] - ord('0')) <= 1).all(axis=1)
+
+        return valid | is_null
+
+
 class ObservationValidator:
-    def __init__(self, df: pd.DataFrame):
+    def __init__(self, df: pd.DataFrame, metrics: ValidationMetrics = None):
+        """
+        Parameters:
+        - df: formatted observations.
+        - metrics: collector for per-check results; by default check timings are only
+          collected when this module's logger is at DEBUG level.
+        """
         self.df = df
+        self.metrics = metrics or ValidationMetrics(detailed=logger.isEnabledFor(logging.DEBUG))
 
         self.validation_map = {
             'TEMP':    [check_extreme_values(-30, 110), check_greater_than('MIN'), check_missing],
@@ -77,19 +298,51 @@ class ObservationValidator:
             'PRCP':    [check_extreme_values(0, 500), check_missing],
             'FRSHTT':  [check_valid_binary_digits(6), check_missing]
         }
+        self.engine = CompiledValidationEngine(self.validation_map)
+
+    def validate_flags(self) -> pd.DataFrame:
+        """
+        Compact validity result: one bitmask column per validated column recording which
+        checks failed (see CompiledValidationEngine.validate_flags).
+        """
+        flags_df = self.engine.validate_flags(self.df, metrics=self.metrics)
+        self.metrics.emit()
+
+        return flags_df
+
+    def validate(self, compiled: bool = True) -> pd.DataFrame:
+        if compiled:
+            validity_df = self.engine.validate(self.df, metrics=self.metrics)
+            self.metrics.emit()
+            return validity_df
 
-    def validate(self) -> pd.DataFrame:
         validity_df = pd.DataFrame(True, index=self.df.index, columns=self.df.columns)
 
+        self.metrics.row_count += len(self.df)
         for col, checks in self.validation_map.items():
             if col in self.df.columns:
                 for check in checks:
-                    result = check(df=self.df, col_name=col)
+                    with self.metrics.timer(f'{col}.{check.__name__}'):
+                        result = check(df=self.df, col_name=col)
+                    self.metrics.record(col, check.__name__, int((~result).sum()))
                     validity_df[col] &= result
 
+        self.metrics.emit()
+
         return validity_df
 
     @staticmethod
     def calculate_percent_of_rows_with_errors(validity_df: pd.DataFrame) -> float:
         return 100 * (~validity_df).mean().mean()
 
+    @staticmethod
+    def calculate_percent_of_rows_with_errors_from_flags(flags_df: pd.DataFrame, column_count: int) -> float:
+        """
+        Same percentage as calculate_percent_of_rows_with_errors, computed from validate_flags
+        output for a DataFrame with `column_count` columns (unvalidated columns are always valid).
+        """
+        cell_count = len(flags_df) * column_count
+        if cell_count == 0:
+            return 0.0
+        return 100 * np.count_nonzero(flags_df.to_numpy()) / cell_count
+
@@ -0,0 +1,399 @@
+import argparse
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from compiled_ensemble import CompiledEnsemble
+from model_data_builder import ModelDFBuilder
+from model_handlers import load_model
+from observation_store import read_station_observations
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 256
+BATCH_WINDOW_SECONDS = 0.002
+MAX_REQUEST_BYTES = 1 << 20
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class StationWindow:
+    """
+    A station's latest max(WINDOW_DAYS) observation rows in a ring buffer, with the features
+    ModelDFBuilder computes for its latest row.
+
+    Appending a day overwrites the oldest row, so an update costs the same however long the
+    station's history is. Instead of running sums (whose add-and-subtract rounding drifts from
+    the builder's), every update re-sums the windows over the buffer, newest row first like
+    ModelDFBuilder.compute_rolling_means, so the features are identical to a build over the
+    station's full history.
+    """
+    FEATURE_NAMES = ModelDFBuilder.BASE_FEATURES + [
+        f'{f}_{d}{ModelDFBuilder.ROLLING_MEAN_SUFFIX}' for f in ModelDFBuilder.BASE_FEATURES for d in ModelDFBuilder.WINDOW_DAYS
+    ]
+
+    def __init__(self):
+        self.size = max(ModelDFBuilder.WINDOW_DAYS)
+        self.values = np.full((self.size, len(ModelDFBuilder.BASE_FEATURES)), np.nan)
+        self.position = -1
+        self.rows = 0
+        # The latest date and its features, replaced together
+        self.latest = (None, None)
+
+    @classmethod
+    def from_observations(cls, obs_df: pd.DataFrame) -> 'StationWindow':
+        """
+        A window over the last rows of a station's observations, indexed by date.
+        """
+        window = cls()
+        obs_df = obs_df.sort_index().iloc[-window.size:]
+        values = obs_df.reindex(columns=ModelDFBuilder.BASE_FEATURES).to_numpy(dtype=np.float64, na_value=np.nan)
+        for date, row in zip(obs_df.index, values):
+            window.append(date, row, compute=False)
+        if window.rows:
+            window.latest = (window.latest[0], window.compute_features())
+
+        return window
+
+    @property
+    def latest_date(self) -> Optional[pd.Timestamp]:
+        return self.latest[0]
+
+    def append(self, date, values: np.ndarray, compute: bool = True):
+        """
+        Adds a day of base feature values (NaN when missing). A new observation of the latest
+        day replaces it; days before it can't be added. Days skipped since the latest one are
+        added as NaN rows, like the builder's gap filling.
+        """
+        date = pd.Timestamp(date)
+        if self.latest_date is not None and date < self.latest_date:
+            raise ValueError(f"Observation for {date.date()} is older than the latest one, {self.latest_date.date()}.")
+
+        days = 1 if self.latest_date is None else (date - self.latest_date).days
+        if days:
+            # Clear the slots of the new day and any skipped ones (the whole buffer for gaps of a window or more)
+            self.values[(self.position + 1 + np.arange(min(days, self.size))) % self.size] = np.nan
+            self.position = (self.position + days) % self.size
+            self.rows = min(self.rows + days, self.size)
+        self.values[self.position] = values
+        self.latest = (date, self.compute_features() if compute else None)
+
+    def compute_features(self) -> np.ndarray:
+        """
+        The latest row's base features followed by its rolling means, in FEATURE_NAMES order.
+        """
+        # Rows newest first; cumulative sums add them in the same order as the builder's windows
+        newest_first = self.values[(self.position - np.arange(self.rows)) % self.size]
+        observed = ~np.isnan(newest_first)
+        window_sums = np.cumsum(np.where(observed, newest_first, 0), axis=0)
+        window_counts = np.cumsum(observed, axis=0)
+
+        # Windows longer than the station's history cover all of it, like the builder's zero padding
+        last_rows = np.minimum(ModelDFBuilder.WINDOW_DAYS, self.rows) - 1
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rolling_means = np.where(
+                window_counts[last_rows] > 0, window_sums[last_rows] / window_counts[last_rows], np.nan
+            )
+
+        return np.concatenate([self.values[self.position], rolling_means.T.reshape(-1)])
+
+    def get_features(self, date: pd.Timestamp) -> np.ndarray:
+        """
+        Features for `date`: all NaN when the station has no observation for it, as in the
+        builder's model data.
+        """
+        latest_date, features = self.latest
+        if latest_date is not None and date < latest_date:
+            raise ValueError(f"Only the latest day ({latest_date.date()}) is kept, not {date.date()}.")
+        if latest_date != date:
+            return np.full(len(self.FEATURE_NAMES), np.nan)
+        return features
+
+
+class LocationModel:
+    """
+    A location's model and the positions of its features among the location's station
+    features, so a request's feature row is assembled with one gather.
+    """
+    def __init__(self, location_name: str, model_s3_uri: str, station_ids: List[str], model):
+        self.location_name = location_name
+        self.model_s3_uri = model_s3_uri
+        self.station_ids = station_ids
+        self.model = model
+
+        if getattr(model, 'feature_names_in_', None) is None:
+            raise ValueError(f"{model_s3_uri} was trained without feature names.")
+        self.feature_names = [str(f) for f in model.feature_names_in_]
+        station_feature_names = pd.Index([
+            f'{feature_name}_{station_id}' for station_id in station_ids for feature_name in StationWindow.FEATURE_NAMES
+        ])
+        self.positions = station_feature_names.get_indexer(self.feature_names)
+        if (self.positions == -1).any():
+            missing_features = [f for f, p in zip(self.feature_names, self.positions) if p == -1]
+            raise ValueError(f"Stations of {location_name} don't provide features of {model_s3_uri}: {missing_features[:5]}")
+
+
+class PredictionService:
+    """
+    Serves predictions from models and station windows kept in memory. Requests are queued
+    and scored in micro-batches: whatever arrives within `batch_window_seconds` of a request
+    (up to `max_batch_size`) is scored with one predict call per model.
+    """
+    def __init__(self, locations: Dict[str, dict], max_batch_size: int = MAX_BATCH_SIZE,
+                 batch_window_seconds: float = BATCH_WINDOW_SECONDS, compile_models: bool = False):
+        """
+        Parameters:
+        - locations: by location name, its `model_s3_uri` and `observation_s3_uris_by_station_id`.
+        - max_batch_size: most requests scored together.
+        - batch_window_seconds: how long a batch waits for more requests.
+        - compile_models: score with models compiled into CompiledEnsembles, which predict a few
+          rows several times faster than sklearn forests.
+        """
+        self.locations = locations
+        self.max_batch_size = max_batch_size
+        self.batch_window_seconds = batch_window_seconds
+        self.compile_models = compile_models
+        self.windows: Dict[str, StationWindow] = {}
+        self.location_models: Dict[str, LocationModel] = {}
+        self.queue = None
+
+    def load(self, workers: int = None):
+        """
+        Loads every model and seeds every station's window from its stored observations.
+        """
+        observation_uris = {}
+        for location in self.locations.values():
+            for station_id, s3_uri in location['observation_s3_uris_by_station_id'].items():
+                observation_uris.setdefault(station_id, s3_uri)
+        model_s3_uris = {location['model_s3_uri'] for location in self.locations.values()}
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            model_futures = {uri: executor.submit(load_model, uri) for uri in model_s3_uris}
+            window_futures = {
+                station_id: executor.submit(
+                    lambda uri: StationWindow.from_observations(
+                        read_station_observations(uri, columns=ModelDFBuilder.BASE_FEATURES)
+                    ), s3_uri
+                )
+                for station_id, s3_uri in observation_uris.items()
+            }
+            self.windows = {station_id: future.result() for station_id, future in window_futures.items()}
+            models = {uri: future.result() for uri, future in model_futures.items()}
+
+        if self.compile_models:
+            models = {
+                uri: model if isinstance(model, CompiledEnsemble) else CompiledEnsemble.from_model(model)
+                for uri, model in models.items()
+            }
+
+        self.location_models = {
+            location_name: LocationModel(
+                location_name,
+                location['model_s3_uri'],
+                list(location['observation_s3_uris_by_station_id']),
+                models[location['model_s3_uri']]
+            )
+            for location_name, location in self.locations.items()
+        }
+        logger.info(f"Loaded {len(models)} models and {len(self.windows)} station windows")
+
+    def update_observation(self, station_id: str, date, values: Dict[str, float]) -> pd.Timestamp:
+        """
+        Adds a station's observations for a day, by base feature name (missing ones are NaN).
+        """
+        if station_id not in self.windows:
+            raise KeyError(f"Unknown station {station_id}.")
+        row = np.array([
+            np.nan if values.get(f) is None else float(values[f]) for f in ModelDFBuilder.BASE_FEATURES
+        ])
+        self.windows[station_id].append(date, row)
+
+        return self.windows[station_id].latest_date
+
+    def get_feature_row(self, location_model: LocationModel, date: pd.Timestamp) -> np.ndarray:
+        station_features = [self.windows[station_id].get_features(date) for station_id in location_model.station_ids]
+        row = np.concatenate(station_features)[location_model.positions]
+        # Model data fills features without observations with 0 (see ModelDFBuilder.change_model_data_resolutions)
+        row[np.isnan(row)] = 0
+        return row
+
+    def get_latest_date(self, location_model: LocationModel) -> pd.Timestamp:
+        dates = [self.windows[s].latest_date for s in location_model.station_ids if self.windows[s].latest_date is not None]
+        if not dates:
+            raise ValueError(f"No observations for {location_model.location_name}.")
+        return max(dates)
+
+    async def predict(self, location_name: str, date=None) -> dict:
+        """
+        Predicts for a location on `date` (by default its latest observed day), through the
+        micro-batching queue.
+        """
+        if location_name not in self.location_models:
+            raise KeyError(f"Unknown location {location_name}.")
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((location_name, date, future))
+        return await future
+
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window_seconds
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self.score_batch(batch)
+
+    async def score_batch(self, batch):
+        """
+        Assembles the batch's feature rows (on the event loop, where observations are updated)
+        and predicts each model's rows in one call on a worker thread.
+        """
+        rows_by_model = {}
+        for location_name, date, future in batch:
+            location_model = self.location_models[location_name]
+            try:
+                date = self.get_latest_date(location_model) if date is None else pd.Timestamp(date)
+                row = self.get_feature_row(location_model, date)
+            except (KeyError, ValueError) as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            rows_by_model.setdefault(location_model.model_s3_uri, []).append((location_model, date, row, future))
+
+        loop = asyncio.get_running_loop()
+        for model_s3_uri, requests in rows_by_model.items():
+            location_model = requests[0][0]
+            X = pd.DataFrame(np.vstack([row for _, _, row, _ in requests]), columns=location_model.feature_names)
+            try:
+                y_pred = await loop.run_in_executor(None, location_model.model.predict, X)
+            except Exception as e:
+                logger.exception(f"Prediction failed for {model_s3_uri}")
+                for *_, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (request_location_model, date, _, future), prediction in zip(requests, y_pred):
+                # Requests whose client went away are cancelled
+                if not future.done():
+                    future.set_result({
+                        'location_name': request_location_model.location_name,
+                        'date': date.date().isoformat(),
+                        'y_pred': float(prediction),
+                        'model_s3_uri': model_s3_uri,
+                    })
+
+    async def route(self, method: str, path: str, body: bytes):
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok', 'locations': len(self.location_models), 'stations': len(self.windows)}
+
+        if method == 'POST' and path == '/predict':
+            request = json.loads(body)
+            return 200, await self.predict(request['location_name'], request.get('date'))
+
+        if method == 'POST' and path == '/observations':
+            request = json.loads(body)
+            # One observation or a list of them
+            observations = request if isinstance(request, list) else [request]
+            latest_dates = {
+                o['station_id']: self.update_observation(o['station_id'], o['date'], o['values']).date().isoformat()
+                for o in observations
+            }
+            return 200, {'latest_dates': latest_dates}
+
+        return 404, {'error': f"No route for {method} {path}"}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        A minimal HTTP/1.1 exchange with JSON bodies and keep-alive.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path = request_line.decode('latin-1').split()[:2]
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                start_time = time.perf_counter()
+                if length > MAX_REQUEST_BYTES:
+                    status, payload = 413, {'error': f"Requests are limited to {MAX_REQUEST_BYTES} bytes."}
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    try:
+                        status, payload = await self.route(method, path, body)
+                    except (KeyError, ValueError, TypeError) as e:
+                        status, payload = 400, {'error': str(e)}
+                    except Exception as e:
+                        logger.exception(f"Failed to handle {method} {path}")
+                        status, payload = 500, {'error': str(e)}
+                logger.debug(f"{method} {path} {status} in {(time.perf_counter() - start_time) * 1000:.2f} ms")
+
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+                if length > MAX_REQUEST_BYTES or headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8080):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self.run_batches())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logger.info(f"Serving predictions on {host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve same-day predictions from models and observation windows in memory.")
+    parser.add_argument('config', help="JSON file with `locations`: by name, a `model_s3_uri` and `observation_s3_uris_by_station_id`")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on")
+    parser.add_argument('--port', type=int, default=8080, help="Port to listen on")
+    parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE, help="Most requests scored together")
+    parser.add_argument('--batch-window-ms', type=float, default=BATCH_WINDOW_SECONDS * 1000, help="How long a batch waits for more requests")
+    parser.add_argument('--compile', action='store_true', help="Score with compiled tree ensembles")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    service = PredictionService(
+        config['locations'],
+        max_batch_size=args.max_batch_size,
+        batch_window_seconds=args.batch_window_ms / 1000,
+        compile_models=args.compile
+    )
+    service.load()
+    asyncio.run(service.serve(args.host, args.port))
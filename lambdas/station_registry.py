@@ -0,0 +1,197 @@
+import logging
+import os
+import time
+from typing import Dict, Tuple
+
+import awswrangler as wr
+import numpy as np
+import pandas as pd
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STATION_METADATA_COLUMNS = ['STATION', 'NAME', 'LATITUDE', 'LONGITUDE', 'ELEVATION', 'DATE']
+RECORDS_PREFIX = 'records'
+REGISTRY_FILE_NAME = 'registry.parquet'
+EARTH_RADIUS_KM = 6371.0088
+
+
+def get_station_record(station_id: str, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Summarizes a raw station file (or just its STATION_METADATA_COLUMNS) into one registry row:
+    the station's metadata, the first and last observed dates, and the number of observed days.
+    """
+    dates = pd.to_datetime(df['DATE'], errors='coerce').dropna()
+    # Coordinates are repeated on every row; use the latest in case the station moved
+    latest = df.loc[dates.idxmax()] if len(dates) else df.iloc[-1]
+
+    return pd.DataFrame([{
+        'station_id': station_id,
+        'station': str(latest['STATION']),
+        'name': latest['NAME'],
+        'latitude': float(latest['LATITUDE']),
+        'longitude': float(latest['LONGITUDE']),
+        'elevation': float(latest['ELEVATION']),
+        'first_date': dates.min(),
+        'last_date': dates.max(),
+        'observation_days': int(dates.nunique()),
+    }])
+
+
+def get_station_record_uri(registry_prefix: str, station_id: str) -> str:
+    return f"{registry_prefix.rstrip('/')}/{RECORDS_PREFIX}/station_id={station_id}.parquet"
+
+
+def get_registry_uri(registry_prefix: str) -> str:
+    return f"{registry_prefix.rstrip('/')}/{REGISTRY_FILE_NAME}"
+
+
+def write_station_record(record_df: pd.DataFrame, registry_prefix: str) -> str:
+    """
+    Writes one station's registry row. Each station has its own record object, so concurrent
+    ingests never overwrite each other; consolidate_station_registry combines them.
+    """
+    record_uri = get_station_record_uri(registry_prefix, record_df['station_id'].iloc[0])
+    if record_uri.startswith('s3://'):
+        wr.s3.to_parquet(record_df, path=record_uri, index=False)
+    else:
+        os.makedirs(os.path.dirname(record_uri), exist_ok=True)
+        record_df.to_parquet(record_uri, index=False)
+
+    return record_uri
+
+
+def consolidate_station_registry(registry_prefix: str) -> str:
+    """
+    Combines every station record under `registry_prefix` into the single registry file that
+    StationRegistry.load reads.
+    """
+    records_prefix = f"{registry_prefix.rstrip('/')}/{RECORDS_PREFIX}/"
+    registry_uri = get_registry_uri(registry_prefix)
+    if registry_prefix.startswith('s3://'):
+        record_uris = wr.s3.list_objects(records_prefix, suffix='.parquet')
+        stations_df = wr.s3.read_parquet(record_uris) if record_uris else pd.DataFrame()
+        wr.s3.to_parquet(stations_df, path=registry_uri, index=False)
+    else:
+        record_paths = sorted(
+            os.path.join(records_prefix, f) for f in os.listdir(records_prefix) if f.endswith('.parquet')
+        ) if os.path.isdir(records_prefix) else []
+        stations_df = pd.concat([pd.read_parquet(p) for p in record_paths], ignore_index=True) if record_paths else pd.DataFrame()
+        stations_df.to_parquet(registry_uri, index=False)
+
+    logger.info(f"Consolidated {len(stations_df)} station records into {registry_uri}")
+    return registry_uri
+
+
+class StationRegistry:
+    """
+    Station metadata with nearest-station lookup. Stations are indexed in a ball tree on their
+    coordinates with the haversine metric, so distances are great-circle distances. Trees are
+    built per requested coverage period and reused for later queries over the same period.
+    """
+    def __init__(self, stations_df: pd.DataFrame):
+        self.stations_df = stations_df.reset_index(drop=True)
+        self.stations_df['first_date'] = pd.to_datetime(self.stations_df['first_date'])
+        self.stations_df['last_date'] = pd.to_datetime(self.stations_df['last_date'])
+        self.coordinates = np.radians(self.stations_df[['latitude', 'longitude']].to_numpy(dtype=np.float64))
+        self.trees = {}
+
+    @classmethod
+    def load(cls, registry_prefix: str) -> 'StationRegistry':
+        registry_uri = get_registry_uri(registry_prefix)
+        if registry_uri.startswith('s3://'):
+            return cls(wr.s3.read_parquet(registry_uri))
+        return cls(pd.read_parquet(registry_uri))
+
+    def get_covering_positions(self, start_date=None, end_date=None) -> np.ndarray:
+        """
+        Positions of the stations whose observations span [start_date, end_date].
+        """
+        covering = np.ones(len(self.stations_df), dtype=bool)
+        if start_date is not None:
+            covering &= (self.stations_df['first_date'] <= pd.Timestamp(start_date)).to_numpy()
+        if end_date is not None:
+            covering &= (self.stations_df['last_date'] >= pd.Timestamp(end_date)).to_numpy()
+
+        return np.flatnonzero(covering)
+
+    def get_tree(self, start_date=None, end_date=None) -> Tuple[object, np.ndarray]:
+        # Imported here so the ingest handlers, which only write station records, don't need scikit-learn
+        from sklearn.neighbors import BallTree
+
+        key = (
+            None if start_date is None else pd.Timestamp(start_date),
+            None if end_date is None else pd.Timestamp(end_date)
+        )
+        if key not in self.trees:
+            positions = self.get_covering_positions(start_date, end_date)
+            tree = BallTree(self.coordinates[positions], metric='haversine') if len(positions) else None
+            self.trees[key] = (tree, positions)
+
+        return self.trees[key]
+
+    def nearest_stations_batch(self, latitudes, longitudes, k: int = 5, radius_km: float = None,
+                               start_date=None, end_date=None) -> pd.DataFrame:
+        """
+        Finds the k nearest stations to each location.
+
+        Parameters:
+        - latitudes, longitudes: location coordinates in degrees.
+        - k: maximum number of stations per location.
+        - radius_km: only stations within this distance (unbounded when None).
+        - start_date, end_date: only stations whose observations span this period.
+
+        Returns:
+        - One row per (location, station) match with `location` (position in the inputs),
+          `rank`, `station_id`, and `distance_km`, ordered by location then distance.
+        """
+        query = np.radians(np.column_stack([
+            np.asarray(latitudes, dtype=np.float64), np.asarray(longitudes, dtype=np.float64)
+        ]))
+        tree, positions = self.get_tree(start_date, end_date)
+        columns = ['location', 'rank', 'station_id', 'distance_km']
+        if tree is None or len(query) == 0:
+            return pd.DataFrame(columns=columns)
+
+        k = min(k, len(positions))
+        distances, indices = tree.query(query, k=k)
+        distances_km = distances * EARTH_RADIUS_KM
+
+        matches = np.ones(distances_km.shape, dtype=bool) if radius_km is None else distances_km <= radius_km
+        locations, ranks = np.nonzero(matches)
+        station_ids = self.stations_df['station_id'].to_numpy()[positions[indices[matches]]]
+
+        return pd.DataFrame({
+            'location': locations,
+            'rank': ranks,
+            'station_id': station_ids,
+            'distance_km': distances_km[matches],
+        }, columns=columns)
+
+    def nearest_stations(self, latitude: float, longitude: float, k: int = 5, radius_km: float = None,
+                         start_date=None, end_date=None) -> Dict[str, float]:
+        """
+        Finds the k nearest stations to one location.
+
+        Returns:
+        - Distance in km by station ID, nearest first.
+        """
+        matches = self.nearest_stations_batch(
+            [latitude], [longitude], k=k, radius_km=radius_km, start_date=start_date, end_date=end_date
+        )
+        return dict(zip(matches['station_id'], matches['distance_km'].astype(float)))
+
+
+# Loaded registries by prefix, kept across invocations of a warm Lambda container
+_registry_cache = {}
+REGISTRY_CACHE_SECONDS = 300
+
+
+def get_station_registry(registry_prefix: str) -> StationRegistry:
+    cached = _registry_cache.get(registry_prefix)
+    if cached is None or time.monotonic() - cached[1] > REGISTRY_CACHE_SECONDS:
+        cached = (StationRegistry.load(registry_prefix), time.monotonic())
+        _registry_cache[registry_prefix] = cached
+
+    return cached[0]
@@ -1,10 +1,10 @@
 import os
+from functools import partial
 import pandas as pd
 from model_data_builder import ModelDFBuilder
 from model_trainer import ModelTrainer
-from observation_formatter import ObservationFormatter
-from observation_validator import ObservationValidator
-from observation_filterer import ObservationFilterer
+from observation_pipeline import process_observation_df
+from observation_store import read_observations
 import pickle
 
 # Define paths for local files
@@ -31,21 +31,11 @@ predictions_file = "results/final_predictions.parquet"
 def process_observations(observation_files):
     filtered_files = {}
     for station_id, file_path in observation_files.items():
-        # Format observations
+        # Format, validate, and filter observations in memory
         df = pd.read_csv(file_path) if file_path.endswith(".csv") else pd.read_parquet(file_path)
-        formatter = ObservationFormatter(df)
-        formatted_df = formatter.format()
-
-        # Validate observations
-        validator = ObservationValidator(formatted_df)
-        validity_df = validator.validate()
-        error_rate = validator.calculate_percent_of_rows_with_errors(validity_df)
+        filtered_df, _, error_rate = process_observation_df(df)
         print(f"Validation error rate for {station_id}: {error_rate:.2f}%")
 
-        # Filter observations
-        filterer = ObservationFilterer(df=formatted_df, validation_df=validity_df)
-        filtered_df = filterer.filter()
-
         # Save filtered observations locally
         filtered_file_path = f"data/filtered_{station_id}.parquet"
         filtered_df.to_parquet(filtered_file_path)
@@ -71,14 +61,14 @@ def run_model_data_builder(observation_files, outcome_file=None, start_date=None
     else:
         raise FileNotFoundError(f"Outcome file not found: {outcome_file}")
 
-    # Load filtered observation data
-    observation_dfs_by_station = {
-        station_id: pd.read_parquet(file_path)
+    # Filtered observation data is read by the builder, only for the dates and columns the features need
+    observation_loaders_by_station = {
+        station_id: partial(read_observations, file_path, columns=ModelDFBuilder.BASE_FEATURES)
         for station_id, file_path in observation_files.items()
     }
 
     # Build the model data
-    model_df_builder = ModelDFBuilder(outcome_df, observation_dfs_by_station)
+    model_df_builder = ModelDFBuilder(outcome_df, observation_loaders_by_station)
     model_data_df = model_df_builder.build_model_df(resolution_days=resolution_days)
 
     # Save the model data locally
@@ -27,10 +27,15 @@ resource "aws_iam_policy" "lambda_policy" {
     Version = "2012-10-17"
     Statement = [
       {
-        Action   = ["s3:GetObject", "s3:PutObject"]
+        Action   = ["s3:GetObject", "s3:PutObject", "s3:DeleteObject"]
         Effect   = "Allow"
         Resource = "${aws_s3_bucket.observation_files.arn}/*"
       },
+      {
+        Action   = "s3:ListBucket"
+        Effect   = "Allow"
+        Resource = aws_s3_bucket.observation_files.arn
+      },
       {
         Action   = "lambda:GetLayerVersion",
         Effect   = "Allow",
@@ -95,6 +100,21 @@ module "formatter_lambda" {
   ]
 }
 
+module "processor_lambda" {
+  source = "terraform-aws-modules/lambda/aws"
+  function_name = "observation_processor_lambda"
+  handler       = var.incremental_ingest ? "observation_handlers.observation_incremental_processor" : "observation_handlers.observation_processor"
+  runtime       = "python3.9"
+  policy          = aws_iam_role.lambda_role.arn
+  source_path = "../lambdas/"
+  timeout = 180
+  memory_size = 1024
+
+  layers = [
+    "arn:aws:lambda:us-east-1:336392948345:layer:AWSSDKPandas-Python39:29"
+  ]
+}
+
 module "step_function_invoker_lambda" {
   source = "terraform-aws-modules/lambda/aws"
   function_name = "observation_ingest_step_function_invoker_lambda"
@@ -113,14 +133,33 @@ module "step_function_invoker_lambda" {
   }
 }
 
+module "station_registry_builder_lambda" {
+  source = "terraform-aws-modules/lambda/aws"
+  function_name = "station_registry_builder_lambda"
+  handler       = "observation_handlers.station_registry_builder"
+  runtime       = "python3.9"
+  policy          = aws_iam_role.lambda_role.arn
+  source_path = "../lambdas/"
+  timeout = 300
+  memory_size = 1024
+
+  layers = [
+    "arn:aws:lambda:us-east-1:336392948345:layer:AWSSDKPandas-Python39:29"
+  ]
+  environment_variables = {
+    OBSERVATION_BUCKET = aws_s3_bucket.observation_files.bucket
+  }
+}
+
 # Step Function
 data "template_file" "step_function_definition" {
-  template = file("${path.module}/ingest_observations_state_machine.json")
+  template = file(var.fused_pipeline ? "${path.module}/ingest_observations_fused_state_machine.json" : "${path.module}/ingest_observations_state_machine.json")
 
   vars = {
     formatter_lambda_arn = module.formatter_lambda.lambda_function_arn
     filterer_lambda_arn   = module.filterer_lambda.lambda_function_arn
     validator_lambda_arn = module.validator_lambda.lambda_function_arn
+    processor_lambda_arn = module.processor_lambda.lambda_function_arn
   }
 }
 
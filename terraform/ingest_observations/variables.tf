@@ -6,3 +6,15 @@ variable "aws_region" {
 variable "project" {
     type        = string
 }
+
+variable "fused_pipeline" {
+    description = "Run format, validate, and filter in a single Lambda instead of three"
+    type        = bool
+    default     = false
+}
+
+variable "incremental_ingest" {
+    description = "Only process new or changed rows in the fused pipeline, appending them to the filtered store"
+    type        = bool
+    default     = false
+}
@@ -32,8 +32,10 @@ module "tf_state" {
 module "ingest_observations" {
   source = "./ingest_observations"
 
-  aws_region = var.aws_region
-  project    = var.project
+  aws_region         = var.aws_region
+  project            = var.project
+  fused_pipeline     = var.fused_observation_pipeline
+  incremental_ingest = var.incremental_observation_ingest
 }
 
 module "model_runner" {
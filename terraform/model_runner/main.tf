@@ -29,10 +29,15 @@ resource "aws_iam_policy" "lambda_policy" {
     Version = "2012-10-17"
     Statement = [
       {
-        Action   = ["s3:GetObject", "s3:PutObject"]
+        Action   = ["s3:GetObject", "s3:PutObject", "s3:DeleteObject"]
         Effect   = "Allow"
         Resource = "${aws_s3_bucket.model_files.arn}/*"
       },
+      {
+        Action   = "s3:ListBucket"
+        Effect   = "Allow"
+        Resource = aws_s3_bucket.model_files.arn
+      },
       {
         Action   = "lambda:GetLayerVersion",
         Effect   = "Allow",
@@ -81,6 +86,7 @@ module "model_data_builder" {
   ]
   environment_variables = {
     MODEL_BUCKET = aws_s3_bucket.model_files.bucket
+    FEATURE_CACHE_URI = var.feature_cache_uri
   }
 }
 
@@ -116,6 +122,25 @@ module "model_runner" {
   }
 }
 
+module "batch_model_runner" {
+  source = "terraform-aws-modules/lambda/aws"
+  function_name = "batch_model_runner"
+  handler       = "model_handlers.batch_model_runner"
+  runtime       = "python3.9"
+  policy          = aws_iam_role.lambda_execution_role.arn
+  source_path = "../lambdas/"
+  timeout = 900
+  memory_size = 3008
+
+  layers = [
+    "arn:aws:lambda:us-east-1:336392948345:layer:AWSSDKPandas-Python39:29"
+  ]
+  environment_variables = {
+    MODEL_BUCKET = aws_s3_bucket.model_files.bucket
+    FEATURE_CACHE_URI = var.feature_cache_uri
+  }
+}
+
 data "template_file" "model_trainer_step_function_definition" {
   template = file("${path.module}/model_training_state_machine.json")
 
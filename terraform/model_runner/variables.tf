@@ -6,3 +6,9 @@ variable "aws_region" {
 variable "project" {
     type        = string
 }
+
+variable "feature_cache_uri" {
+    description = "S3 prefix to cache station features under. Empty disables the cache."
+    type        = string
+    default     = ""
+}
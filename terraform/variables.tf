@@ -12,3 +12,13 @@ variable "environment" {
   type        = string
   default = "dev"
 }
+
+variable "fused_observation_pipeline" {
+  type        = bool
+  default     = false
+}
+
+variable "incremental_observation_ingest" {
+  type        = bool
+  default     = false
+}